@@ -0,0 +1,96 @@
+"""
+CPU placement of executor processes.
+
+Plans which CPUs each executor slot may run on, keeping processes within a
+NUMA node where possible. Linux only.
+"""
+from __future__ import absolute_import
+
+import glob
+import os
+import re
+
+
+NODE_PATH = '/sys/devices/system/node'
+
+
+def parse_cpus(spec):
+    """
+    Parse a CPU list such as "0-3,8,10-11" into a sorted list.
+    """
+    cpus = set()
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if not re.match(r'^\d+(-\d+)?$', part):
+            raise ValueError('Invalid CPU list: %s' % spec)
+        if '-' in part:
+            low, high = map(int, part.split('-'))
+            cpus.update(range(low, high + 1))
+        else:
+            cpus.add(int(part))
+    return sorted(cpus)
+
+
+def available_cpus():
+    """
+    Return the CPUs this process may run on.
+    """
+    return sorted(os.sched_getaffinity(0))
+
+
+def numa_nodes(cpus=None):
+    """
+    Return a list of the available CPUs of each NUMA node.
+
+    Without NUMA information, all CPUs are treated as one node.
+    """
+    cpus = set(available_cpus() if cpus is None else cpus)
+    nodes = []
+    paths = glob.glob(os.path.join(NODE_PATH, 'node[0-9]*', 'cpulist'))
+    for path in sorted(paths, key=lambda p: int(re.findall(r'\d+', p)[-1])):
+        with open(path) as f:
+            node = [cpu for cpu in parse_cpus(f.read()) if cpu in cpus]
+        if node:
+            nodes.append(node)
+    # CPUs missing from sysfs, if any, form their own node.
+    missing = cpus.difference(*nodes)
+    if missing:
+        nodes.append(sorted(missing))
+    return nodes
+
+
+def plan(mode, processes):
+    """
+    Return the CPUs for each of `processes` slots.
+
+    `mode` is "auto" to give each process all CPUs of one NUMA node, nodes
+    taken in turn; "per-process" to give each process a single CPU, spread
+    across nodes; or a CPU list shared by all processes.
+    """
+    if mode == 'auto':
+        nodes = numa_nodes()
+        return [nodes[i % len(nodes)] for i in range(processes)]
+    if mode == 'per-process':
+        nodes = numa_nodes()
+        # Interleave nodes, so processes are spread evenly.
+        cpus = [node[i] for i in range(max(map(len, nodes)))
+                for node in nodes if i < len(node)]
+        if processes > len(cpus):
+            raise ValueError('%s processes but only %s CPUs' % (processes,
+                                                                len(cpus)))
+        return [[cpu] for cpu in cpus[:processes]]
+    cpus = parse_cpus(mode)
+    unavailable = set(cpus) - set(available_cpus())
+    if unavailable:
+        raise ValueError('CPUs not available: %s' %
+                         ','.join(map(str, sorted(unavailable))))
+    return [cpus] * processes
+
+
+def pin(cpus):
+    """
+    Restrict this process (and any it later starts) to `cpus`.
+    """
+    os.sched_setaffinity(0, cpus)
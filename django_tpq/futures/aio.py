@@ -0,0 +1,321 @@
+"""
+asyncio support for futures.
+
+Allows submitting futures and awaiting their results from a running event loop
+without blocking it and without threads. Database access uses asynchronous
+psycopg2 connections driven by the event loop.
+"""
+from __future__ import absolute_import
+
+import asyncio
+import logging
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+from psycopg2.extras import Json
+
+from django.db import connections
+
+from main.models import BLOCK_INTERVAL, NODE_ERRORS, QueueFull
+from futures.futures import (
+    FUTURES_RESULT_CHANNEL, FUTURES_RESULT_DATABASE, get_queue_model,
+    get_results
+)
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Seconds between checks of all outstanding results. This is a safety net for
+# missed notifications, normally results are fetched when NOTIFY arrives.
+SWEEP_INTERVAL = 5.0
+# Seconds before reconnecting after losing the LISTEN connection, doubling
+# with each failed attempt up to RECONNECT_MAX.
+RECONNECT_INTERVAL = 1.0
+RECONNECT_MAX = 30.0
+
+
+class AsyncConnection(object):
+    """
+    Asynchronous psycopg2 connection driven by an asyncio event loop.
+
+    Only one query may run at a time on a connection, concurrent callers are
+    serialized.
+    """
+
+    def __init__(self, alias, loop):
+        self.alias = alias
+        self.loop = loop
+        self.lock = asyncio.Lock(loop=loop)
+        self.conn = None
+
+    async def _wait_fd(self, add, remove):
+        fd = self.conn.fileno()
+        waiter = self.loop.create_future()
+        add(fd, lambda: waiter.done() or waiter.set_result(None))
+        try:
+            await waiter
+        finally:
+            remove(fd)
+
+    async def _poll(self):
+        """
+        Drive the connection until the current operation completes.
+        """
+        while True:
+            state = self.conn.poll()
+            if state == psycopg2.extensions.POLL_OK:
+                return
+            elif state == psycopg2.extensions.POLL_READ:
+                await self._wait_fd(self.loop.add_reader,
+                                    self.loop.remove_reader)
+            elif state == psycopg2.extensions.POLL_WRITE:
+                await self._wait_fd(self.loop.add_writer,
+                                    self.loop.remove_writer)
+            else:
+                raise psycopg2.OperationalError('poll() returned %s' % state)
+
+    async def connect(self):
+        if self.conn is not None:
+            return
+        params = connections[self.alias].get_connection_params()
+        params['async_'] = True
+        self.conn = psycopg2.connect(**params)
+        await self._poll()
+
+    async def execute(self, sql, params=None):
+        """
+        Execute a query, returning the cursor once it completes.
+        """
+        async with self.lock:
+            await self.connect()
+            cursor = self.conn.cursor()
+            cursor.execute(sql, params)
+            await self._poll()
+            return cursor
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+class AsyncResultListener(object):
+    """
+    Wait for Future results on behalf of many coroutines.
+
+    LISTENs for result notifications on a dedicated asynchronous connection and
+    fetches the results of watched futures using a single cache round trip per
+    wakeup. There should be only one of these per event loop, use
+    get_listener().
+    """
+
+    def __init__(self, loop, alias=FUTURES_RESULT_DATABASE,
+                 channel=FUTURES_RESULT_CHANNEL):
+        self.loop = loop
+        self.channel = channel
+        self.connection = AsyncConnection(alias, loop)
+        self.watched = {}
+        self.started = None
+
+    async def start(self):
+        """
+        Begin LISTENing, only the first call has any effect.
+        """
+        if self.started is None:
+            self.started = asyncio.ensure_future(self._start(),
+                                                 loop=self.loop)
+        await asyncio.shield(self.started, loop=self.loop)
+
+    async def _start(self):
+        try:
+            await self._listen()
+        except psycopg2.Error:
+            # Let the next caller try again.
+            self.connection.close()
+            self.started = None
+            raise
+        self.loop.call_later(SWEEP_INTERVAL, self._sweep)
+
+    async def _listen(self):
+        await self.connection.execute('LISTEN "%s"' % self.channel)
+        self.loop.add_reader(self.connection.conn.fileno(), self._readable)
+
+    async def _reconnect(self):
+        """
+        LISTEN on a new connection, retrying with backoff until it succeeds.
+        """
+        delay = RECONNECT_INTERVAL
+        while True:
+            await asyncio.sleep(delay, loop=self.loop)
+            try:
+                await self._listen()
+            except psycopg2.Error as e:
+                LOGGER.warning('Result listener reconnect failed: %s', e)
+                self.connection.close()
+                delay = min(delay * 2, RECONNECT_MAX)
+                continue
+            LOGGER.info('Result listener reconnected')
+            # Notifications may have been missed while disconnected.
+            self._check(list(self.watched.keys()))
+            return
+
+    def _readable(self):
+        conn = self.connection.conn
+        fd = conn.fileno()
+        try:
+            conn.poll()
+        except psycopg2.Error as e:
+            LOGGER.warning('Result listener connection lost: %s', e)
+            # The fd would stay readable, stop watching it until reconnected.
+            self.loop.remove_reader(fd)
+            self.connection.close()
+            asyncio.ensure_future(self._reconnect(), loop=self.loop)
+            return
+        uids = set(n.payload for n in conn.notifies)
+        del conn.notifies[:]
+        self._check(uids)
+
+    def _sweep(self):
+        # Check everything in case we missed a NOTIFY.
+        self._check(list(self.watched.keys()))
+        self.loop.call_later(SWEEP_INTERVAL, self._sweep)
+
+    def _check(self, uids):
+        uids = [uid for uid in uids if uid in self.watched]
+        if not uids:
+            return
+        # The Django cache API is synchronous, but this is a single round trip
+        # for any number of results.
+        try:
+            results = get_results(uids)
+        except Exception as e:
+            LOGGER.exception(e)
+            return
+        for uid, result in results.items():
+            for waiter in self.watched.pop(uid, ()):
+                if not waiter.done():
+                    waiter.set_result(result)
+
+    async def wait(self, uid, timeout=None):
+        """
+        Wait for the raw cached result for `uid`.
+
+        Raises TimeoutError if timeout (in seconds) expires first.
+        """
+        await self.start()
+        waiter = self.loop.create_future()
+        # Watch before checking so we cannot miss the notification.
+        self.watched.setdefault(uid, []).append(waiter)
+        self._check([uid])
+        try:
+            return await asyncio.wait_for(waiter, timeout, loop=self.loop)
+        except asyncio.TimeoutError:
+            raise TimeoutError('Future %s incomplete' % uid)
+        finally:
+            waiters = self.watched.get(uid, [])
+            if waiter in waiters:
+                waiters.remove(waiter)
+                if not waiters:
+                    del self.watched[uid]
+
+
+# Per event loop. Entries refer to their loop, so cannot be weakly keyed on
+# it, instead those of closed loops are dropped by _prune().
+_CONNECTIONS = {}
+_LISTENERS = {}
+
+
+def _prune():
+    """
+    Close and forget the connections and listeners of closed event loops.
+    """
+    for loop in [loop for loop in _CONNECTIONS if loop.is_closed()]:
+        for connection in _CONNECTIONS.pop(loop).values():
+            connection.close()
+    for loop in [loop for loop in _LISTENERS if loop.is_closed()]:
+        _LISTENERS.pop(loop).connection.close()
+
+
+def get_connection(alias, loop=None):
+    """
+    Return the AsyncConnection used for queries to `alias` on this event loop.
+    """
+    loop = loop or asyncio.get_event_loop()
+    _prune()
+    pool = _CONNECTIONS.setdefault(loop, {})
+    if alias not in pool:
+        pool[alias] = AsyncConnection(alias, loop)
+    return pool[alias]
+
+
+def get_listener(loop=None):
+    """
+    Return the AsyncResultListener for this event loop.
+    """
+    loop = loop or asyncio.get_event_loop()
+    _prune()
+    if loop not in _LISTENERS:
+        _LISTENERS[loop] = AsyncResultListener(loop)
+    return _LISTENERS[loop]
+
+
+async def aoverloaded(manager):
+    """
+    Return manager.overloaded(), checking the depth without blocking.
+    """
+    if not manager.model.high_water:
+        return False
+    depth = manager.cached_depth()
+    if depth is None:
+        cursor = await get_connection(manager.db).execute(
+            *manager.depth_query())
+        depth = manager.cache_depth(cursor.fetchone()[0])
+    return manager.overloaded(depth)
+
+
+async def aadmit(manager, message):
+    """
+    Apply the queue's overload policy as manager.admit() does, without
+    blocking the event loop.
+    """
+    if not await aoverloaded(manager):
+        return True
+    if manager.model.overload == 'block':
+        deadline = time.time() + manager.model.overload_timeout
+        while time.time() < deadline:
+            await asyncio.sleep(BLOCK_INTERVAL)
+            if not await aoverloaded(manager):
+                return True
+        raise QueueFull('Queue %s is full, timed out after %ss' %
+                        (manager.model._meta.label,
+                         manager.model.overload_timeout))
+    return manager.refuse(message)
+
+
+async def aenqueue(queue_name, message):
+    """
+    Add a message to a queue without blocking the event loop.
+
+    As enqueue(), applies the queue's overload policy, returning False if it
+    refused the message, and fails over between the queue's databases. The
+    message is inserted at once, it cannot join an enqueue_batch().
+    """
+    manager = get_queue_model(queue_name).objects
+    error = None
+    # Round-robin across the queue's databases, if it has several.
+    for alias in manager._rotation():
+        node = manager.db_manager(alias)
+        connection = get_connection(alias)
+        try:
+            if not await aadmit(node, message):
+                return False
+            await connection.execute('INSERT INTO "%s" (data) VALUES (%%s)' %
+                                     node.table, [Json(message)])
+            return True
+        except NODE_ERRORS as e:
+            connection.close()
+            manager.mark_down(alias)
+            error = e
+    raise error
@@ -0,0 +1,39 @@
+"""
+Entry point for executor processes started in a fresh interpreter.
+
+After a reload, futures_executor starts workers with the "spawn" method so
+they import the code currently on disk rather than inheriting the
+supervisor's. This module is imported before Django is set up, so it imports
+everything else lazily.
+"""
+from __future__ import absolute_import
+
+
+def run_executor(**options):
+    """
+    Set up Django, import all futures and run an executor process.
+
+    DJANGO_SETTINGS_MODULE is inherited from the supervisor.
+    """
+    import django
+    django.setup()
+
+    from futures.futures import autodiscover, get_queue_model
+    from futures.management.commands.futures_executor import executor_p
+
+    autodiscover()
+    executor_p(get_queue_model(options['queue_name']), **options)
+
+
+def call_child(conn, blob):
+    """
+    Run a call_with_timeout() child, forked by the forkserver.
+
+    Sets up Django in case the forkserver could not.
+    """
+    import django
+    django.setup()
+
+    from futures.futures import _call_child
+
+    _call_child(conn, blob)
@@ -3,9 +3,7 @@ Decorators for django_tpq.
 """
 from __future__ import absolute_import
 
-from futures.futures import (
-    Future, FUTURES_REGISTRY
-)
+from futures.futures import Future, register
 
 
 def future(*args, **kwargs):
@@ -17,7 +15,7 @@ def future(*args, **kwargs):
         wrapped = Future(f, *args, **kwargs)
 
         # Register the future object.
-        FUTURES_REGISTRY[wrapped.name] = wrapped
+        register(wrapped)
 
         # Return the future object.
         return wrapped
@@ -0,0 +1,258 @@
+"""
+concurrent.futures compatible Executor.
+"""
+from __future__ import absolute_import
+
+import concurrent.futures
+import logging
+import os
+import threading
+import time
+
+from select import select
+
+from django.conf import settings
+from django.db import connections
+
+from main.models import QueueFull
+from futures.futures import (
+    Future, FUTURES_REGISTRY, FUTURES_RESULT_CHANNEL, FUTURES_RESULT_DATABASE,
+    get_queue_model, get_results, message_uid, _unpack_result
+)
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Seconds between checks of all outstanding results. This is a safety net for
+# missed notifications, normally results are fetched when NOTIFY arrives.
+SWEEP_INTERVAL = 5.0
+# Seconds to wait before reconnecting after losing the LISTEN connection.
+RECONNECT_INTERVAL = 1.0
+
+
+def complete(f, result):
+    """
+    Complete a concurrent.futures.Future using a raw cached result.
+    """
+    try:
+        f.set_result(_unpack_result(result))
+    except Exception as e:
+        f.set_exception(e)
+
+
+class ResultListener(object):
+    """
+    Wait for Future results on behalf of many waiters.
+
+    A single thread LISTENs for result notifications and fetches the results of
+    watched futures using a single cache round trip per wakeup. There should be
+    only one of these per process, use get_listener().
+    """
+
+    def __init__(self, alias=FUTURES_RESULT_DATABASE,
+                 channel=FUTURES_RESULT_CHANNEL):
+        self.alias = alias
+        self.channel = channel
+        self.watched = {}
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.error = None
+        self.thread = None
+
+    def _connect(self):
+        """
+        Open a dedicated connection for LISTEN.
+
+        This connection is not managed by Django, so it is not shared with
+        any other thread.
+        """
+        wrapper = connections[self.alias]
+        conn = wrapper.get_new_connection(wrapper.get_connection_params())
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute('LISTEN "%s"' % self.channel)
+        return conn
+
+    def start(self):
+        """
+        Start the listener thread, waiting until it is LISTENing.
+
+        Raises the error if the first connection fails.
+        """
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        self.ready.wait()
+        if self.error is not None:
+            raise self.error
+
+    def is_alive(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def watch(self, uid, f):
+        """
+        Complete concurrent.futures.Future `f` when result `uid` arrives.
+        """
+        with self.lock:
+            self.watched[uid] = f
+
+    def unwatch(self, uid):
+        with self.lock:
+            self.watched.pop(uid, None)
+
+    def _check(self, uids):
+        with self.lock:
+            uids = [uid for uid in uids if uid in self.watched]
+        if not uids:
+            return
+        for uid, result in get_results(uids).items():
+            with self.lock:
+                f = self.watched.pop(uid, None)
+            if f is not None:
+                complete(f, result)
+
+    def run(self):
+        """
+        Listener thread.
+
+        Reconnects if the connection is lost. Results that arrived meanwhile
+        are found by the sweep that follows reconnecting.
+        """
+        try:
+            conn = self._connect()
+        except Exception as e:
+            self.error = e
+            return
+        finally:
+            self.ready.set()
+
+        while True:
+            try:
+                self._listen(conn)
+            except Exception as e:
+                LOGGER.exception(e)
+            try:
+                conn.close()
+            except Exception:
+                pass
+            conn = None
+            while conn is None:
+                time.sleep(RECONNECT_INTERVAL)
+                try:
+                    conn = self._connect()
+                except Exception as e:
+                    LOGGER.warning('Result listener reconnect failed: %s', e)
+
+    def _listen(self, conn):
+        """
+        Wait for notifications until the connection fails.
+        """
+        # Check everything first, in case we were disconnected.
+        uids = None
+        while True:
+            if uids is None or not any(
+                    select([conn], [], [], SWEEP_INTERVAL)):
+                # Timed out, check everything in case we missed a NOTIFY.
+                with self.lock:
+                    uids = list(self.watched.keys())
+            else:
+                conn.poll()
+                uids = set(n.payload for n in conn.notifies)
+                del conn.notifies[:]
+            try:
+                self._check(uids)
+            except Exception as e:
+                LOGGER.exception(e)
+
+
+_LISTENER = (None, None)
+_LISTENER_LOCK = threading.Lock()
+
+
+def get_listener():
+    """
+    Return the ResultListener for this process, starting it if necessary.
+    """
+    global _LISTENER
+    with _LISTENER_LOCK:
+        pid, listener = _LISTENER
+        # A forked child does not inherit our listener thread, and a listener
+        # whose thread died must be replaced.
+        if pid != os.getpid() or not listener.is_alive():
+            listener = ResultListener()
+            listener.start()
+            _LISTENER = (os.getpid(), listener)
+        return listener
+
+
+class TPQExecutor(concurrent.futures.Executor):
+    """
+    Executor that dispatches registered futures via a queue.
+
+    Returns concurrent.futures.Future instances that are completed by a single
+    listener thread per process, so add_done_callback(), wait() and
+    as_completed() from concurrent.futures work as usual.
+    """
+
+    def __init__(self, queue_name=settings.FUTURES_QUEUE_NAME):
+        self.queue_name = queue_name
+        self.Model = get_queue_model(queue_name)
+        self._pending = set()
+        self._shutdown = False
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Schedule fn(*args, **kwargs) for execution by futures_executor.
+
+        fn must be a registered future. Raises QueueFull if the queue's
+        overload policy dropped or diverted the call.
+        """
+        if isinstance(fn, Future):
+            future = fn
+        else:
+            name = '%s.%s' % (fn.__module__, fn.__name__)
+            future = FUTURES_REGISTRY.get(name)
+            if future is None:
+                raise ValueError('%s is not a registered future' % name)
+        if future.store != 'all':
+            # The returned future could never complete.
+            raise ValueError('Results of %s are not always stored' %
+                             future.name)
+
+        message = future.message(args, kwargs)
+        f = concurrent.futures.Future()
+        listener = get_listener()
+
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError('cannot schedule new futures after '
+                                   'shutdown')
+            # Watch before enqueuing so we cannot miss the notification.
+            listener.watch(message_uid(message), f)
+            try:
+                queued = self.Model.objects.enqueue(message)
+            except Exception:
+                listener.unwatch(message_uid(message))
+                raise
+            if not queued:
+                # No result will ever arrive.
+                listener.unwatch(message_uid(message))
+                raise QueueFull('Queue %s is full, call of %s refused' %
+                                (self.Model._meta.label, future.name))
+            # Once queued, a future cannot be cancelled.
+            f.set_running_or_notify_cancel()
+            self._pending.add(f)
+
+        f.add_done_callback(self._done)
+        return f
+
+    def _done(self, f):
+        with self._lock:
+            self._pending.discard(f)
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            self._shutdown = True
+            pending = list(self._pending)
+        if wait:
+            concurrent.futures.wait(pending)
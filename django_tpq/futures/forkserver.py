@@ -0,0 +1,16 @@
+"""
+Preloaded by the forkserver that starts processes for futures with a timeout.
+
+The forkserver is a fresh, single-threaded interpreter, so processes forked
+from it cannot inherit locks held by executor threads. Setting up Django here
+means each process starts ready to run.
+"""
+from __future__ import absolute_import
+
+import django
+
+django.setup()
+
+from futures.futures import autodiscover  # noqa: E402
+
+autodiscover()
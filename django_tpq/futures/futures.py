@@ -4,12 +4,22 @@ Future implementation.
 from __future__ import absolute_import
 
 import abc
+import base64
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
 import functools
 import json
 import logging
+import multiprocessing
+import os
+import random
+import signal
 import sys
+import threading
 import time
+import traceback
 import uuid
+import zlib
 
 import dill
 
@@ -18,44 +28,148 @@ from tblib import Traceback
 from django.apps import apps
 from django.conf import settings
 from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS, connections
 from django.db.models import F
 from django.utils import timezone
+from django.utils.module_loading import autodiscover_modules
 
-from futures.models import FutureStat
+from futures.models import FutureStat, FutureStatHistory
+from futures import bootstrap, routing, storage
+from futures.profiling import PROFILER
+from futures.signals import post_execute, pre_execute
+from futures.throttle import Throttle
 
 
 LOGGER = logging.getLogger(__name__)
 FUTURES_REGISTRY = {}
+# Registered futures by id, see future_id().
+FUTURES_IDS = {}
+FUTURES_RESULT_CHANNEL = getattr(settings, 'FUTURES_RESULT_CHANNEL',
+                                 'futures_results')
+FUTURES_RESULT_DATABASE = getattr(settings, 'FUTURES_RESULT_DATABASE',
+                                  DEFAULT_DB_ALIAS)
+FUTURES_DEAD_LETTER_QUEUE = getattr(settings, 'FUTURES_DEAD_LETTER_QUEUE',
+                                    'futures.FutureDeadLetter')
+# Upper limit for exponential retry backoff in seconds.
+RETRY_MAX_DELAY = getattr(settings, 'FUTURES_RETRY_MAX_DELAY', 3600)
+# Format of new messages. Both versions are always accepted, set this to 2
+# once all executors understand version 2.
+MESSAGE_VERSION = getattr(settings, 'FUTURES_MESSAGE_VERSION', 1)
+
+
+def set_result(uid, obj, progress=0, file=False, ttl=None):
+    """
+    Place a Future result into cache for ttl seconds, FUTURES_CACHE_TTL by
+    default.
 
-
-def set_result(uid, obj, progress=0):
-    """Place a Future result into cache."""
-    if isinstance(obj, tuple) and isinstance(obj[1], Exception):
-        # Wrap the tb so it can be transported and re-raised.
-        et, ev, tb = obj
-        obj = (et, ev, Traceback(tb))
-    obj = dill.dumps(obj)
+    Large results, or any result if file is True, are written to a file and
+    only a reference is cached. See futures.storage.
+    """
     result = {
         'uid': uid,
-        'obj': obj,
         'ts': time.time(),
         'progress': progress,
     }
+    if isinstance(obj, tuple) and isinstance(obj[1], Exception):
+        # Wrap the tb so it can be transported and re-raised.
+        et, ev, tb = obj
+        result['obj'] = dill.dumps((et, ev, Traceback(tb)))
+    elif file or storage.wants_file(obj):
+        result['file'] = storage.save(uid, obj)
+    else:
+        result['obj'] = dill.dumps(obj)
     cache = caches[settings.FUTURES_CACHE_BACKEND]
-    cache.set('futures:%s' % uid, result, settings.FUTURES_CACHE_TTL)
+    if ttl is None:
+        ttl = settings.FUTURES_CACHE_TTL
+    cache.set('futures:%s' % uid, result, ttl)
 
 
-def get_result(uid):
-    """Retrieve a Future result from cache."""
-    cache = caches[settings.FUTURES_CACHE_BACKEND]
-    result = cache.get('futures:%s' % uid)
-    if result is None:
-        return
-    # Clean this up even though we set a TTL.
-    cache.delete('futures:%s' % uid)
+class UnknownFuture(LookupError):
+    """
+    Raised when a message names a future that is not registered.
+    """
+
+
+class FutureTimeout(TimeoutError):
+    """
+    Raised when a future exceeds its execution time limit.
+    """
+
+
+class ResultNotStored(RuntimeError):
+    """
+    Raised when waiting for a result that will never be stored.
+    """
+
+
+def future_id(name):
+    """
+    Return the id identifying a future in version 2 messages.
+    """
+    return zlib.crc32(name.encode('utf8'))
+
+
+def register(future):
+    """
+    Register a future, so executors can find it by name or id.
+    """
+    fid = future_id(future.name)
+    other = FUTURES_IDS.get(fid)
+    if other is not None and other.name != future.name:
+        raise ImproperlyConfigured('Futures "%s" and "%s" have the same id, '
+                                   'rename one' % (other.name, future.name))
+    FUTURES_REGISTRY[future.name] = future
+    FUTURES_IDS[fid] = future
+
+
+def lookup(message):
+    """
+    Return the registered future a message calls, or None.
+    """
+    if 'f' in message:
+        return FUTURES_IDS.get(message['f'])
+    return FUTURES_REGISTRY.get(message['name'])
+
+
+def message_uid(message):
+    """
+    Return the uid of a message of either version.
+    """
+    return message['u'] if 'u' in message else message['uid']
+
+
+def autodiscover():
+    """
+    Import the futures module of each installed app.
+
+    This registers all futures declared with @future(). The executor calls
+    this before forking so modules are loaded once and shared by workers.
+    """
+    autodiscover_modules('futures')
+
+
+def notify_result(uid):
+    """
+    NOTIFY listeners that a Future result is available.
+
+    The payload is the uid of the Future.
+    """
+    with connections[FUTURES_RESULT_DATABASE].cursor() as cursor:
+        cursor.execute('SELECT pg_notify(%s, %s)',
+                       [FUTURES_RESULT_CHANNEL, uid])
+
+
+def _unpack_result(result):
+    """Unpickle a cached result, re-raising it if it is an exception."""
     # TODO: how do we want to report/represent progress? One idea is to use a
     # generator such that each future function yields it's progress, and we
     # update the result with that progress.
+    if 'file' in result:
+        # Files can only be opened once, retain the object.
+        if 'loaded' not in result:
+            result['loaded'] = storage.load(result['file'])
+        return result['loaded']
     obj = dill.loads(result['obj'])
     if isinstance(obj, tuple) and isinstance(obj[1], Exception):
         # Unpack and reraise the exception.
@@ -64,6 +178,288 @@ def get_result(uid):
     return obj
 
 
+def get_result(uid):
+    """Retrieve a Future result from cache."""
+    cache = caches[settings.FUTURES_CACHE_BACKEND]
+    result = cache.get('futures:%s' % uid)
+    if result is None:
+        return
+    # Clean this up even though we set a TTL.
+    cache.delete('futures:%s' % uid)
+    return _unpack_result(result)
+
+
+def get_results(uids):
+    """
+    Retrieve many Future results from cache.
+
+    Uses a single get_many() and delete_many() regardless of the number of
+    uids. Returns a dictionary mapping the uid of each available result to the
+    raw cached result, use _unpack_result() to obtain the value.
+    """
+    cache = caches[settings.FUTURES_CACHE_BACKEND]
+    keys = {'futures:%s' % uid: uid for uid in uids}
+    found = cache.get_many(keys.keys())
+    if not found:
+        return {}
+    # Clean these up even though we set a TTL.
+    cache.delete_many(found.keys())
+    return {keys[key]: result for key, result in found.items()}
+
+
+class StatsBuffer(object):
+    """
+    Accumulate per-minute statistics in memory.
+
+    Buckets are written to FutureStatHistory using a single upsert at most
+    once per `interval` seconds, rather than once per execution. Executor
+    threads call maybe_flush() while idle, so buckets are not held back until
+    the next execution.
+    """
+
+    def __init__(self, interval=10):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.rows = {}
+        self.flushed = time.time()
+
+    def record(self, name, failed, elapsed):
+        """
+        Record an execution of future `name` that took `elapsed` seconds.
+        """
+        start = timezone.now().replace(second=0, microsecond=0)
+        with self.lock:
+            row = self.rows.setdefault((name, start), [0, 0, 0.0, 0.0])
+            row[0] += 1
+            row[1] += int(failed)
+            row[2] += elapsed
+            row[3] = max(row[3], elapsed)
+        self.maybe_flush()
+
+    def maybe_flush(self):
+        """
+        Write accumulated statistics if `interval` seconds have passed.
+        """
+        with self.lock:
+            due = self.rows and time.time() - self.flushed >= self.interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        """
+        Write accumulated statistics.
+        """
+        with self.lock:
+            rows, self.rows = self.rows, {}
+            self.flushed = time.time()
+        if not rows:
+            return
+        try:
+            FutureStatHistory.objects.upsert(rows)
+        except Exception as e:
+            LOGGER.exception(e)
+
+
+STATS = StatsBuffer(getattr(settings, 'FUTURES_STATS_INTERVAL', 10))
+
+
+# Database connections inherited from a parent process, see
+# forget_connections().
+_INHERITED = (None, [])
+
+
+def forget_connections():
+    """
+    Stop using database connections inherited from a parent process.
+
+    They must not be used or closed by this process, so keep references to
+    them and let Django open new ones. Child processes exit via os._exit(), so
+    they are never finalized. Only the first call in a process has any effect.
+    """
+    global _INHERITED
+    if _INHERITED[0] == os.getpid():
+        return
+    inherited = []
+    for alias in connections:
+        inherited.append(connections[alias])
+        del connections[alias]
+    _INHERITED = (os.getpid(), inherited)
+
+
+def _capture(f, args, kwargs):
+    """
+    Call f, returning its result or exception as a dill blob.
+    """
+    try:
+        r = (True, f(*args, **kwargs))
+    except BaseException:
+        et, ev, tb = sys.exc_info()
+        r = (False, (et, ev, Traceback(tb)))
+    return dill.dumps(r)
+
+
+def _restore(blob):
+    """
+    Return the result captured by _capture() or re-raise its exception.
+    """
+    ok, r = dill.loads(blob)
+    if not ok:
+        et, ev, tb = r
+        raise ev.with_traceback(tb.as_traceback())
+    return r
+
+
+def _call_child(conn, blob):
+    """
+    Child process side of call_with_timeout().
+    """
+    f, args, kwargs = dill.loads(blob)
+    conn.send_bytes(_capture(f, args, kwargs))
+    conn.close()
+
+
+# Children of call_with_timeout() are started by a forkserver rather than
+# forked from an executor, which has many threads.
+_FORKSERVER = multiprocessing.get_context('forkserver')
+_FORKSERVER.set_forkserver_preload(['futures.forkserver'])
+
+
+def call_with_timeout(f, args, kwargs, timeout):
+    """
+    Call f(*args, **kwargs) in a child process, killing it after `timeout`
+    seconds.
+
+    Returns the result or re-raises the exception raised by f. Raises
+    FutureTimeout if the time limit is exceeded, a `timeout` of None waits
+    indefinitely.
+    """
+    recv, send = _FORKSERVER.Pipe(duplex=False)
+    p = _FORKSERVER.Process(target=bootstrap.call_child,
+                            args=(send, dill.dumps((f, args, kwargs))))
+    p.start()
+    send.close()
+    try:
+        if not recv.poll(timeout):
+            # SIGKILL, as f may handle SIGTERM.
+            os.kill(p.pid, signal.SIGKILL)
+            raise FutureTimeout('Execution exceeded %ss' % timeout)
+        try:
+            blob = recv.recv_bytes()
+        except EOFError:
+            p.join()
+            raise RuntimeError('Execution process died, exit code %s' %
+                               p.exitcode)
+    finally:
+        recv.close()
+        p.join()
+    return _restore(blob)
+
+
+# Process pool for futures declared with executor='process', see
+# get_process_pool().
+_PROCESS_POOL = (None, None)
+_PROCESS_POOL_LOCK = threading.Lock()
+PROCESS_POOL_SIZE = getattr(settings, 'FUTURES_CPU_POOL', None)
+
+
+def _create_process_pool(size):
+    """
+    Return a new process pool, or None if one cannot be started safely.
+
+    Where supported (Python 3.7+), workers are started by the forkserver.
+    Otherwise they are forked, which is only safe before this process starts
+    other threads, so executors start the pool first.
+    """
+    try:
+        return concurrent.futures.ProcessPoolExecutor(
+            size, mp_context=_FORKSERVER)
+    except TypeError:
+        pass
+    if threading.active_count() > 1:
+        return None
+    return concurrent.futures.ProcessPoolExecutor(size)
+
+
+def get_process_pool(size=None):
+    """
+    Return the process pool for this process, creating it if necessary.
+
+    When created, the pool has `size` workers, or PROCESS_POOL_SIZE if not
+    given, by default one per CPU. Returns None if there is no pool and one
+    cannot be started safely.
+    """
+    global _PROCESS_POOL
+    with _PROCESS_POOL_LOCK:
+        pid, pool = _PROCESS_POOL
+        # A forked child cannot use our pool.
+        if pid != os.getpid():
+            pool = _create_process_pool(size or PROCESS_POOL_SIZE)
+            _PROCESS_POOL = (os.getpid(), pool) if pool else (None, None)
+        return pool
+
+
+def shutdown_process_pool():
+    """
+    Shut down the process pool for this process, if any.
+    """
+    global _PROCESS_POOL
+    with _PROCESS_POOL_LOCK:
+        pid, pool = _PROCESS_POOL
+        _PROCESS_POOL = (None, None)
+    if pid == os.getpid():
+        pool.shutdown()
+
+
+def _discard_process_pool(pool):
+    """
+    Stop using a broken pool, the next get_process_pool() creates another.
+    """
+    global _PROCESS_POOL
+    with _PROCESS_POOL_LOCK:
+        if _PROCESS_POOL == (os.getpid(), pool):
+            _PROCESS_POOL = (None, None)
+    pool.shutdown(wait=False)
+
+
+def _call_pool(blob):
+    """
+    Process pool side of call_in_pool().
+
+    The function is sent with its arguments, workers may have been forked
+    before it was registered.
+    """
+    forget_connections()
+    f, args, kwargs = dill.loads(blob)
+    return _capture(f, args, kwargs)
+
+
+def call_in_pool(future, args, kwargs):
+    """
+    Call a future in the process pool, waiting for the result.
+
+    Returns the result or re-raises the exception raised by the future. If a
+    worker dies the pool is replaced and RuntimeError is raised. Without a
+    pool, the call runs in a child of the forkserver instead.
+    """
+    blob = dill.dumps((future.f, args, kwargs))
+    pool = get_process_pool()
+    try:
+        pending = pool and pool.submit(_call_pool, blob)
+    except BrokenProcessPool:
+        # Broken by another call, retry in a new pool.
+        _discard_process_pool(pool)
+        pool = get_process_pool()
+        pending = pool and pool.submit(_call_pool, blob)
+    if pending is None:
+        return call_with_timeout(future.f, args, kwargs, None)
+    try:
+        blob = pending.result()
+    except BrokenProcessPool:
+        _discard_process_pool(pool)
+        raise RuntimeError('Process pool worker died')
+    return _restore(blob)
+
+
 def get_queue_model(queue_name):
     label, _, model = queue_name.partition('.')
     return apps.get_model(app_label=label, model_name=model)
@@ -89,6 +485,14 @@ class BaseSerializer(object):
         """Convert blob into object."""
         pass
 
+    def pack(self, obj):
+        """Convert obj to a compact JSON compatible form."""
+        return self.serialize(obj)
+
+    def unpack(self, blob):
+        """Convert the result of pack() into object."""
+        return self.deserialize(blob)
+
 
 class DillSerializer(BaseSerializer):
     """
@@ -105,6 +509,15 @@ class DillSerializer(BaseSerializer):
         """Convert blob into object."""
         return dill.loads(blob.encode('latin-1'))
 
+    def pack(self, obj):
+        """Convert obj to base64 of the most compact pickle."""
+        return base64.b64encode(
+            dill.dumps(obj, dill.HIGHEST_PROTOCOL)).decode('ascii')
+
+    def unpack(self, blob):
+        """Convert the result of pack() into object."""
+        return dill.loads(base64.b64decode(blob))
+
 
 class JSONSerializer(BaseSerializer):
     """
@@ -129,11 +542,44 @@ class Future(object):
     """
 
     def __init__(self, f, queue_name=settings.FUTURES_QUEUE_NAME,
-                 serializer=DillSerializer):
+                 serializer=DillSerializer, max_concurrency=None, rate=None,
+                 timeout=None, executor='thread', retries=0, backoff=1.0,
+                 dead_letter=None, file_result=False, ignore_result=False,
+                 result_ttl=None, store='all', routing_key=None):
+        if executor not in ('thread', 'process'):
+            raise ValueError('executor must be "thread" or "process"')
+        if store not in ('all', 'errors'):
+            raise ValueError('store must be "all" or "errors"')
         self.f = f
+        self.executor = executor
         self.serializer = serializer()
         self.queue_name = queue_name
+        if timeout is None:
+            timeout = getattr(settings, 'FUTURES_TIMEOUT', None)
+        self.timeout = timeout
+        if file_result and not storage.RESULT_DIR:
+            raise ImproperlyConfigured('file_result requires '
+                                       'FUTURES_RESULT_DIR')
+        self.file_result = file_result
+        # What results are placed in the cache: all, errors or none.
+        self.store = 'none' if ignore_result else store
+        if result_ttl is None:
+            result_ttl = settings.FUTURES_CACHE_TTL
+        self.result_ttl = result_ttl
+        # Called with the arguments of each call, calls with equal keys are
+        # routed to the same executor process. See futures.routing.
+        self.routing_key = routing_key
+        self.retries = retries
+        self.backoff = backoff
+        # By default, only futures that are retried are dead-lettered.
+        self.dead_letter = bool(retries) if dead_letter is None \
+            else dead_letter
         functools.update_wrapper(self, f)
+        self.throttle = None
+        if max_concurrency or rate:
+            self.throttle = Throttle(self.name,
+                                     max_concurrency=max_concurrency,
+                                     rate=rate)
 
     def __call__(self, *args, **kwargs):
         """
@@ -148,50 +594,225 @@ class Future(object):
     def async(self, *args, **kwargs):
         """
         Schedule a Future for execution.
+
+        Returns None if the queue's overload policy dropped or diverted the
+        call, as no result will be stored.
         """
-        uid = str(uuid.uuid4())
-        message = {
-            'uid': uid,
-            'name': self.name,
-            'args': self.serializer.serialize(args),
-            'kwargs': self.serializer.serialize(kwargs),
-        }
+        message = self.message(args, kwargs)
         Model = get_queue_model(self.queue_name)
-        Model.objects.enqueue(message)
-        return FutureResult(uid, self)
+        if not Model.objects.enqueue(message):
+            return None
+        return FutureResult(message_uid(message), self)
+
+    async def asubmit(self, *args, **kwargs):
+        """
+        Schedule a Future for execution without blocking the event loop.
+
+        Returns None if the queue's overload policy dropped or diverted the
+        call.
+        """
+        from futures.aio import aenqueue
+        message = self.message(args, kwargs)
+        if not await aenqueue(self.queue_name, message):
+            return None
+        return FutureResult(message_uid(message), self)
+
+    def message(self, args, kwargs):
+        """
+        Build the queue message for a call of this Future.
+
+        Version 2 messages identify the future by id and pack args and kwargs
+        together, using short keys. Version 1 messages use the future's name
+        and serialize args and kwargs separately.
+        """
+        if MESSAGE_VERSION == 2:
+            message = {
+                'v': 2,
+                'f': future_id(self.name),
+                'u': str(uuid.uuid4()),
+                't': time.time(),
+                'p': self.serializer.pack([args, kwargs]),
+            }
+        else:
+            message = {
+                'uid': str(uuid.uuid4()),
+                'ts': time.time(),
+                'name': self.name,
+                'args': self.serializer.serialize(args),
+                'kwargs': self.serializer.serialize(kwargs),
+            }
+        if self.routing_key is not None:
+            message['route'] = routing.route(self.routing_key(*args, **kwargs))
+        return message
 
     @staticmethod
-    def execute(message):
+    def execute(message, Model=None):
         """
         Used by task runner to execute a Future.
 
-        Manages FutureStat.
+        Manages FutureStat. Throttled and retried futures are deferred by
+        placing them back on their queue (Model) with a delay. Arguments are
+        only decoded once the call is about to run.
+        """
+        future = lookup(message)
+        if future is None:
+            # Fail fast, let any waiter know rather than leaving them hanging.
+            if 'f' in message:
+                error = 'Unknown future id %s' % message['f']
+            else:
+                error = 'Future "%s" is not registered' % message['name']
+            LOGGER.error(error)
+            try:
+                raise UnknownFuture(error)
+            except UnknownFuture:
+                set_result(message_uid(message), sys.exc_info())
+            notify_result(message_uid(message))
+            return
+
+        slot = None
+        if future.throttle is not None:
+            delay, slot = future.throttle.acquire()
+            if delay:
+                # Don't block this thread, other futures may proceed.
+                LOGGER.debug('Future "%s" throttled, deferring %.1fs',
+                             future.name, delay)
+                Model = Model or get_queue_model(future.queue_name)
+                Model.objects.enqueue(message, delay=delay)
+                return
+
+        try:
+            future._execute(message, Model)
+        finally:
+            if future.throttle is not None:
+                future.throttle.release(slot)
+
+    def retry_delay(self, attempt):
+        """
+        Return the delay in seconds before retry number `attempt`.
+
+        backoff may be a callable accepting attempt, otherwise it is the
+        initial delay, which doubles with each attempt. Delays are jittered
+        to spread retries.
+        """
+        if callable(self.backoff):
+            return self.backoff(attempt)
+        delay = min(self.backoff * 2 ** (attempt - 1), RETRY_MAX_DELAY)
+        return random.uniform(0.5, 1.0) * delay
+
+    def _retry(self, message, Model):
+        """
+        Schedule a failed call for retry, if any attempts remain.
+        """
+        attempt = message.get('attempt', 0)
+        if attempt >= self.retries:
+            return False
+        delay = self.retry_delay(attempt + 1)
+        LOGGER.warning('Future "%s" raised exception, retry %s of %s in '
+                       '%.1fs', self.name, attempt + 1, self.retries, delay,
+                       exc_info=True)
+        Model = Model or get_queue_model(self.queue_name)
+        Model.objects.enqueue(dict(message, attempt=attempt + 1), delay=delay)
+        return True
+
+    def _dead_letter(self, message, Model, exc_info):
+        """
+        Place a finally failed call on the dead-letter queue.
+        """
+        Model = Model or get_queue_model(self.queue_name)
+        DeadLetter = get_queue_model(FUTURES_DEAD_LETTER_QUEUE)
+        DeadLetter.objects.enqueue({
+            'queue': Model._meta.label,
+            'name': self.name,
+            'message': message,
+            'error': ''.join(traceback.format_exception_only(*exc_info[:2])),
+            'failed_at': timezone.now().isoformat(),
+        })
+
+    def _call(self, args, kwargs):
+        """
+        Call the function as configured.
+        """
+        if self.timeout:
+            # Run in a child process that can be killed.
+            return call_with_timeout(self.f, args, kwargs, self.timeout)
+        elif self.executor == 'process':
+            # Run in the process pool, avoiding the GIL.
+            return call_in_pool(self, args, kwargs)
+        # Only calls in this thread can be profiled.
+        elif PROFILER.sample():
+            return PROFILER.profile(self.name, self.f, args, kwargs)
+        return self(*args, **kwargs)
+
+    def _arguments(self, message):
+        """
+        Decode the args and kwargs of a message.
+        """
+        if 'p' in message:
+            return self.serializer.unpack(message['p'])
+        return (self.serializer.deserialize(message['args']),
+                self.serializer.deserialize(message['kwargs']))
+
+    def _execute(self, message, Model=None):
+        """
+        Execute a call of this Future, storing its result.
+
+        Failed calls are retried, if configured, before their exception is
+        stored as the result. Results are only serialized and stored as the
+        store policy requires. Sends pre_execute and post_execute signals.
         """
-        future = FUTURES_REGISTRY.get(message['name'])
-        args = future.serializer.deserialize(message['args'])
-        kwargs = future.serializer.deserialize(message['kwargs'])
+        start = time.time()
+        uid = message_uid(message)
+        timings = {'wait': start - message.get('t', message.get('ts', start))}
+        args, kwargs = self._arguments(message)
+        timings['deserialize'] = time.time() - start
 
-        stat, _ = FutureStat.objects.get_or_create(name=future.name)
+        stat, _ = FutureStat.objects.get_or_create(name=self.name)
         stat.update(last_seen=timezone.now(), total=F('total') + 1,
                     running=F('running') + 1)
 
-        failed = {}
+        pre_execute.send(sender=Future, future=self, message=message)
+
+        counts, stored = {}, False
+        start = time.time()
         try:
             try:
-                r = future(*args, **kwargs)
-            except:
-                LOGGER.warning('Future "%s" raised exception', future.name,
+                r = self._call(args, kwargs)
+            except BaseException:
+                timings['run'] = time.time() - start
+                if self._retry(message, Model):
+                    # The caller waits for the final attempt.
+                    counts['retried'] = F('retried') + 1
+                    return
+                counts['failed'] = F('failed') + 1
+                LOGGER.warning('Future "%s" raised exception', self.name,
                                exc_info=True)
-                failed['failed'] = F('failed') + 1
-                set_result(message['uid'], sys.exc_info())
+                if self.store != 'none':
+                    set_result(uid, sys.exc_info(),
+                               ttl=self.result_ttl)
+                    stored = True
+                if self.dead_letter:
+                    self._dead_letter(message, Model, sys.exc_info())
             else:
-                LOGGER.debug('Future "%s" successful', future.name)
-                set_result(message['uid'], r)
+                timings['run'] = time.time() - start
+                LOGGER.debug('Future "%s" successful', self.name)
+                if self.store == 'all':
+                    serialize = time.time()
+                    set_result(uid, r, file=self.file_result,
+                               ttl=self.result_ttl)
+                    timings['serialize'] = time.time() - serialize
+                    stored = True
         finally:
-            stat.update(running=F('running') - 1, **failed)
+            # Retried attempts are not failures, until the final one.
+            failed = 'failed' in counts
+            stat.update(running=F('running') - 1, **counts)
+            STATS.record(self.name, failed, timings['run'])
+            PROFILER.log_slow(self.name, message, timings)
+            post_execute.send(sender=Future, future=self, message=message,
+                              failed=failed, timings=timings)
 
-        # TODO: we may wish to do a NOTIFY here to inform any result() waiters
-        # that data may be available for them.
+        if stored:
+            # Inform any listeners that a result is available.
+            notify_result(uid)
 
 
 class FutureResult(object):
@@ -202,21 +823,130 @@ class FutureResult(object):
     def __init__(self, uid, task):
         self.uid = uid
         self.task = task
+        # Raw cached result, retained once fetched since fetching removes it
+        # from the cache.
+        self._result = None
+
+    def done(self):
+        """
+        Return True if the result has been retrieved.
+        """
+        return self._result is not None
+
+    def _set_result(self, result):
+        self._result = result
+
+    def check_wait(self, forever=False):
+        """
+        Raise ResultNotStored if waiting could never end.
+
+        Results of futures declared with ignore_result are never stored. Those
+        declared with store='errors' are only stored on failure, so they may
+        be waited on only for a limited time.
+        """
+        if self._result is not None:
+            return
+        store = self.task.store
+        if store == 'none':
+            raise ResultNotStored('Results of %s are not stored' %
+                                  self.task.name)
+        if store == 'errors' and forever:
+            raise ResultNotStored('Results of %s are only stored on failure, '
+                                  'wait with a timeout' % self.task.name)
 
     def result(self, wait=0):
         """
         Wait for Future results.
+
+        Returns None if `wait` seconds pass first, waits indefinitely if `wait`
+        is negative.
         """
-        while True:
+        if wait != 0:
+            self.check_wait(forever=wait < 0)
+        while self._result is None:
             # TODO: I don't like polling, we could use LISTEN here, even
             # globally so that any waiters would check if their future was
             # complete. Even if all were awakened for each completed future, it
             # would be more efficient than polling.
-            result = get_result(self.uid)
-            if result is not None:
-                return result
-            if wait == 0:
+            self._result = get_results([self.uid]).get(self.uid)
+            if self._result is not None:
                 break
+            if wait == 0:
+                return
             if wait > 0:
                 wait = max(0, wait - 0.5)
             time.sleep(wait if wait > 0 else 0.5)
+        return _unpack_result(self._result)
+
+    async def aresult(self, timeout=None):
+        """
+        Await Future results without blocking the event loop.
+
+        Waits indefinitely unless timeout (in seconds) is given, raises
+        TimeoutError if it expires first.
+        """
+        if self._result is None:
+            self.check_wait(forever=timeout is None)
+            from futures.aio import get_listener
+            self._result = await get_listener().wait(self.uid, timeout)
+        return _unpack_result(self._result)
+
+
+def as_completed(results, timeout=None):
+    """
+    Yield FutureResults as they complete.
+
+    All outstanding results are checked using a single cache round trip per
+    tick. The yielded instances have their result retained, so calling
+    result() on them does not touch the cache again. Raises TimeoutError if
+    timeout (in seconds) expires before all results have arrived.
+    """
+    results = list(results)
+    # Refuse up front, rather than after yielding some results.
+    for r in results:
+        r.check_wait(forever=timeout is None)
+
+    pending, total = {}, 0
+    for r in results:
+        total += 1
+        if r.done():
+            yield r
+        else:
+            pending.setdefault(r.uid, []).append(r)
+
+    if timeout is not None:
+        deadline = time.time() + timeout
+
+    while pending:
+        for uid, result in get_results(pending.keys()).items():
+            for r in pending.pop(uid):
+                r._set_result(result)
+                yield r
+
+        if not pending:
+            break
+
+        if timeout is None:
+            time.sleep(0.5)
+            continue
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            incomplete = sum(len(rs) for rs in pending.values())
+            raise TimeoutError('%s of %s futures incomplete' %
+                               (incomplete, total))
+        time.sleep(min(remaining, 0.5))
+
+
+def gather(results, timeout=None):
+    """
+    Wait for many FutureResults, returning their values in order.
+
+    Exceptions raised by futures are re-raised, as with result(). Raises
+    TimeoutError if timeout (in seconds) expires before all results have
+    arrived.
+    """
+    results = list(results)
+    for _ in as_completed(results, timeout=timeout):
+        pass
+    return [r.result() for r in results]
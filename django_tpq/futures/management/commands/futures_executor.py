@@ -2,22 +2,35 @@ from __future__ import absolute_import
 
 import logging
 import multiprocessing
+import os
+import resource
 import signal
 import time
 import threading
 
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django import db
 
+from futures import affinity, bootstrap, profiling, storage
+from futures.routing import HashRing
 from futures.futures import (
-    Future, get_queue_model
+    Future, FUTURES_REGISTRY, STATS, autodiscover, get_process_pool,
+    get_queue_model, shutdown_process_pool
 )
 
 
 LOGGER = logging.getLogger(__name__)
 
+# Seconds between checks for delayed futures that are due.
+PROMOTE_INTERVAL = 1.0
+# Seconds between removals of expired result files.
+CLEANUP_INTERVAL = 60.0
+# Longest a thread blocks waiting for a future, so that it notices it is
+# asked to stop (for example, draining during a rolling restart).
+STOP_INTERVAL = 5.0
+
 
 def delete_connections():
     """
@@ -30,17 +43,166 @@ def delete_connections():
         del db.connections[c]
 
 
-def executor_t(Model, stopping, limit=-1, wait=0, **options):
+def get_rss():
+    """
+    Return the resident set size of this process in MB.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize() / 1024 / 1024
+    except (IOError, OSError):
+        # Not Linux, fall back to peak RSS (reported in KB).
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Recycler(object):
+    """
+    Track per-process limits.
+
+    Once the process has executed `max_tasks` futures, or its RSS exceeds
+    `max_rss` MB, signals the supervisor that the process is retiring (so that
+    it can start a replacement) and asks all threads to stop.
+    """
+
+    def __init__(self, stopping, retiring, max_tasks=0, max_rss=0):
+        self.stopping = stopping
+        self.retiring = retiring
+        self.max_tasks = max_tasks
+        self.max_rss = max_rss
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def done(self):
+        """
+        Called after each execution.
+        """
+        with self.lock:
+            self.count += 1
+            count = self.count
+
+        if self.max_tasks and count >= self.max_tasks:
+            LOGGER.info('Process task limit reached after %s tasks', count)
+        elif self.max_rss and get_rss() >= self.max_rss:
+            LOGGER.info('Process memory limit reached after %s tasks', count)
+        else:
+            return
+
+        if self.retiring is not None:
+            self.retiring.set()
+        self.stopping.set()
+
+
+class Promoter(object):
+    """
+    Move delayed (deferred or throttled) futures onto the queue.
+
+    Shared by the threads of a process, so that promotion runs at most once
+    every `interval` seconds per process, in whichever thread is first.
+    """
+
+    def __init__(self, Model, interval=PROMOTE_INTERVAL):
+        self.Model = Model
+        self.interval = interval
+        self.promoted = 0
+        self.lock = threading.Lock()
+
+    def maybe_promote(self):
+        with self.lock:
+            if time.time() - self.promoted < self.interval:
+                return
+            self.promoted = time.time()
+        try:
+            self.Model.objects.promote()
+        except Exception as e:
+            LOGGER.exception(e)
+
+
+class RollingRestart(object):
+    """
+    Replace executor processes a batch at a time.
+
+    Each replacement is started before its predecessor is asked to drain and
+    exit, which happens once the replacement is ready. The next batch starts
+    once the previous one has exited, so at least as many processes are
+    dequeuing throughout. If a replacement dies before it is ready, its
+    predecessor is kept and the restart is abandoned.
+    """
+
+    def __init__(self, slots, batch=1):
+        self.stale = list(slots)
+        self.batch = batch
+        # (slot, old, new) awaiting readiness, and old processes exiting.
+        self.swaps = []
+        self.exiting = []
+
+    def done(self):
+        return not (self.stale or self.swaps or self.exiting)
+
+    def abandon(self):
+        """
+        Ask all old processes to exit, returning them.
+        """
+        for _, old, _ in self.swaps:
+            old.terminate()
+        return [old for _, old, _ in self.swaps] + self.exiting
+
+    def step(self, pool, start):
+        """
+        Advance the restart, replacing pool entries using `start(slot)`.
+        """
+        for i, (slot, old, new) in enumerate(self.swaps):
+            if pool[slot] is not new:
+                # The supervisor restarted a replacement that died, track
+                # the process now in the slot.
+                new = pool[slot]
+                self.swaps[i] = (slot, old, new)
+
+        for swap in self.swaps[:]:
+            slot, old, new = swap
+            if new.ready.is_set():
+                self.swaps.remove(swap)
+                LOGGER.info('Process %s ready, draining %s', new.pid, old.pid)
+                old.terminate()
+                self.exiting.append(old)
+            elif not new.is_alive():
+                self.swaps.remove(swap)
+                LOGGER.error('Process %s died before it was ready, keeping '
+                             '%s and abandoning restart', new.pid, old.pid)
+                pool[slot] = old
+                self.stale = []
+
+        self.exiting = [p for p in self.exiting if p.is_alive()]
+        while self.stale and len(self.swaps) + len(self.exiting) < self.batch:
+            slot = self.stale.pop(0)
+            old = pool[slot]
+            new = pool[slot] = start(slot)
+            LOGGER.info('Replacing process %s with %s', old.pid, new.pid)
+            self.swaps.append((slot, old, new))
+
+
+def executor_t(Model, stopping, limit=-1, wait=0, recycler=None, routes=None,
+               promoter=None, **options):
     """
     Executor thread.
 
     Entry point for worker threads. Will iteratively dequeue and process
-    futures until signaled to stop or until limit is reached.
+    futures until signaled to stop or until limit is reached. Futures on
+    `routes` are preferred. Delayed futures are promoted using `promoter`,
+    shared by the process's threads.
     """
+    promoter = promoter or Promoter(Model)
+    # As tpq, wait < 0 does not wait and 0 waits forever, but never block
+    # longer than STOP_INTERVAL.
+    if wait == 0 or wait > STOP_INTERVAL:
+        wait = STOP_INTERVAL
     while not stopping.is_set():
+        promoter.maybe_promote()
+        STATS.maybe_flush()
 
         try:
-            Future.execute(Model.objects.dequeue(wait=wait))
+            Future.execute(Model.objects.dequeue(wait=wait, routes=routes),
+                           Model)
         except ObjectDoesNotExist:
             LOGGER.info('Queue empty, sleeping')
             time.sleep(0.5)
@@ -48,6 +210,9 @@ def executor_t(Model, stopping, limit=-1, wait=0, **options):
         except Exception as e:
             LOGGER.exception(e)
 
+        if recycler is not None:
+            recycler.done()
+
         if limit > 0:
             limit -= 1
 
@@ -58,15 +223,30 @@ def executor_t(Model, stopping, limit=-1, wait=0, **options):
     LOGGER.info('Thread exiting')
 
 
-def executor_p(Model, limit=-1, wait=0, threads=1, **options):
+def executor_p(Model, limit=-1, wait=0, threads=1, retiring=None,
+               max_tasks_per_process=0, max_rss_mb=0, cpu_pool=0,
+               profile_rate=0.0, profile_dir=None, slow_threshold=0.0,
+               slot=0, processes=1, route_group=1, ready=None, cpus=None,
+               **options):
     """
     Executor process.
 
     Entry point for worker processes. Starts the specified number of threads.
     Handles SIGTERM by asking them to exit gracefully. Then waits for them to
-    exit. Each thread will process `limit` tasks before exiting itself.
+    exit. Each thread will process `limit` tasks before exiting itself. The
+    process retires once it reaches `max_tasks_per_process` tasks or
+    `max_rss_mb` MB RSS, setting `retiring` and draining its threads. Futures
+    declared with executor='process' run in a pool of `cpu_pool` processes.
+    A `profile_rate` fraction of executions are profiled into `profile_dir`
+    and executions over `slow_threshold` seconds are logged. If any future is
+    routed, the process prefers the routes that `slot` (of `processes`) owns,
+    shared with `route_group` - 1 other processes. `ready` is set once
+    threads are started. If given, the process is pinned to `cpus`.
     """
     stopping = threading.Event()
+    recycler = Recycler(stopping, retiring, max_tasks=max_tasks_per_process,
+                        max_rss=max_rss_mb)
+    promoter = Promoter(Model)
 
     def _signal(*args):
         LOGGER.info('Received signal')
@@ -74,25 +254,54 @@ def executor_p(Model, limit=-1, wait=0, threads=1, **options):
 
     # Exit gracefully (after current work) on TERM signal.
     signal.signal(signal.SIGTERM, _signal)
+    # Reloading is the supervisor's job.
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
 
     # Ensure database connections are not inherited.
     delete_connections()
 
+    profiling.configure(profile_rate, profile_dir, slow_threshold)
+
+    if cpus:
+        # Before starting the pool, so its workers are pinned too.
+        affinity.pin(cpus)
+
+    if cpu_pool or any(f.executor == 'process'
+                       for f in FUTURES_REGISTRY.values()):
+        # Warm the pool before starting any threads, so its workers are forked
+        # from a single-threaded process.
+        get_process_pool(cpu_pool).submit(os.getpid).result()
+
+    routes = None
+    if any(f.routing_key for f in FUTURES_REGISTRY.values()):
+        ring = HashRing(range(processes))
+        routes = ring.routes(slot, route_group)
+        LOGGER.info('Slot %s owns %s routes', slot, len(routes))
+
     def _thread(**kwargs):
         t = threading.Thread(target=executor_t, args=(Model, stopping),
-                             kwargs=kwargs)
+                             kwargs=dict(kwargs, recycler=recycler,
+                                         promoter=promoter))
         t.start()
         return t
 
     pool = []
     LOGGER.info('Starting %s threads', threads)
     for i in range(threads):
-        pool.append(_thread(limit=limit, wait=wait, **options))
+        pool.append(_thread(limit=limit, wait=wait, routes=routes, **options))
+    if ready is not None:
+        ready.set()
 
     for t in pool:
         t.join()
         LOGGER.info('Thread %s died', t.ident)
 
+    # Write any statistics not yet flushed.
+    STATS.flush()
+    if profile_rate:
+        profiling.PROFILER.dump()
+    shutdown_process_pool()
+
     LOGGER.info('All threads terminated, process exiting')
 
 
@@ -120,47 +329,160 @@ class Command(BaseCommand):
                                  'default: 0 (no limit).')
         parser.add_argument('--restart', action='store_true', default=True,
                             help='Restart dead processes.')
+        parser.add_argument('--cpu-pool', type=int, default=0,
+                            help='Number of processes per executor process '
+                                 'used to run futures declared with '
+                                 'executor="process". default: 0 (one per '
+                                 'CPU, started on demand).')
+        parser.add_argument('--max-tasks-per-process', type=int, default=0,
+                            help='Replace each process after it executes '
+                                 'this many futures. default: 0 (no limit).')
+        parser.add_argument('--max-rss-mb', type=int, default=0,
+                            help='Replace each process once its RSS exceeds '
+                                 'this many MB. default: 0 (no limit).')
+        parser.add_argument('--profile-rate', type=float, default=0.0,
+                            help='Fraction of executions to profile. '
+                                 'default: 0 (none).')
+        parser.add_argument('--profile-dir',
+                            help='Directory for aggregated pstats files, one '
+                                 'per future and process.')
+        parser.add_argument('--slow-threshold', type=float, default=0.0,
+                            help='Log executions slower than this many '
+                                 'seconds. default: 0 (disabled).')
+        parser.add_argument('--route-group', type=int, default=1,
+                            help='Number of processes sharing each route of '
+                                 'routed futures. default: 1')
+        parser.add_argument('--cpu-affinity', metavar='auto|per-process|CPUS',
+                            help='Pin processes to CPUs: "auto" for one NUMA '
+                                 'node each, "per-process" for one CPU '
+                                 'each, or a CPU list such as 0-7,16-23 '
+                                 'shared by all. default: no pinning.')
+        parser.add_argument('--restart-batch', type=int, default=1,
+                            help='Number of processes replaced at a time by a '
+                                 'rolling restart (SIGHUP). default: 1')
 
     def handle(self, *args, **options):
         """
         Dequeue and execute futures.
         """
         Model = get_queue_model(options['queue_name'])
+        if options['profile_rate'] and not options['profile_dir']:
+            raise CommandError('--profile-rate requires --profile-dir')
         stopping = threading.Event()
 
-        def _process(**kwargs):
-            p = multiprocessing.Process(target=executor_p, args=(Model,),
-                                        kwargs=kwargs)
+        # CPUs for each slot, kept when a slot's process is replaced.
+        placement = [None] * options['processes']
+        if options['cpu_affinity']:
+            if not hasattr(os, 'sched_setaffinity'):
+                raise CommandError('--cpu-affinity is not supported on this '
+                                   'platform')
+            try:
+                placement = affinity.plan(options['cpu_affinity'],
+                                          options['processes'])
+            except ValueError as e:
+                raise CommandError(str(e))
+
+        # Import futures before forking, so workers share them and can execute
+        # any future immediately.
+        autodiscover()
+        LOGGER.info('Discovered %s futures', len(FUTURES_REGISTRY))
+        db.connections.close_all()
+
+        # Once reloaded, processes are spawned so that they import new code.
+        reloading, spawn = threading.Event(), False
+
+        def _process(slot, **kwargs):
+            # A replacement takes over the slot, and so the routes, of the
+            # process it replaces.
+            ctx = multiprocessing.get_context('spawn' if spawn else 'fork')
+            retiring, ready = ctx.Event(), ctx.Event()
+            kwargs = dict(kwargs, slot=slot, retiring=retiring, ready=ready,
+                          cpus=placement[slot])
+            if spawn:
+                p = ctx.Process(target=bootstrap.run_executor, kwargs=kwargs)
+            else:
+                p = ctx.Process(target=executor_p, args=(Model,),
+                                kwargs=kwargs)
+            p.retiring, p.ready = retiring, ready
             p.start()
+            if placement[slot]:
+                LOGGER.info('Process %s (slot %s) pinned to CPUs %s', p.pid,
+                            slot, ','.join(map(str, placement[slot])))
             return p
 
         def _signal(*args):
             LOGGER.info('Received signal')
             stopping.set()
 
+        def _reload(*args):
+            LOGGER.info('Received SIGHUP, starting rolling restart')
+            reloading.set()
+
         signal.signal(signal.SIGTERM, _signal)
+        signal.signal(signal.SIGHUP, _reload)
 
-        pool = []
+        # Live processes, and retired processes that are still draining.
+        pool, draining = [], []
         LOGGER.info('Starting %s processes', options['processes'])
         for i in range(options['processes']):
-            pool.append(_process(**options))
+            pool.append(_process(i, **options))
 
+        # Result files are kept as long as the longest lived cache entry.
+        max_age = max([settings.FUTURES_CACHE_TTL] +
+                      [f.result_ttl for f in FUTURES_REGISTRY.values()])
+        cleaned, rolling = 0, None
         try:
             while not stopping.is_set():
 
+                if reloading.is_set():
+                    # Restarts all slots, even if a restart is in progress.
+                    reloading.clear()
+                    spawn = True
+                    if rolling is not None:
+                        draining.extend(rolling.abandon())
+                    rolling = RollingRestart(range(len(pool)),
+                                             options['restart_batch'])
+
+                if rolling is not None:
+                    rolling.step(pool, lambda slot: _process(slot, **options))
+                    if rolling.done():
+                        LOGGER.info('Rolling restart complete')
+                        rolling = None
+
                 # TODO: use tpq.listen_wait(), then notify worker processes.
                 # Disable waiting in workers. Workers mostly sleep, not using
                 # connections.
 
-                # Check if any workers have died.
+                # Check if any workers have died or are retiring.
                 for i, p in enumerate(pool):
-                    if not p.is_alive():
+                    if p.retiring.is_set() and options['restart']:
+                        # Replace it now, it will exit once drained.
+                        LOGGER.info('Process %s retiring', p.pid)
+                        draining.append(p)
+                        p = pool[i] = _process(i, **options)
+                        LOGGER.info('Started replacement process %s', p.pid)
+                    elif not p.is_alive():
                         LOGGER.info('Process %s died', p.pid)
                         del p
                         if options['restart']:
-                            p = pool[i] = _process(**options)
+                            p = pool[i] = _process(i, **options)
                             LOGGER.info('Restarted process %s', p.pid)
 
+                # Remove result files that were never read.
+                if time.time() - cleaned >= CLEANUP_INTERVAL:
+                    try:
+                        storage.cleanup(max_age)
+                    except Exception as e:
+                        LOGGER.exception(e)
+                    cleaned = time.time()
+
+                # Reap drained processes.
+                for p in draining[:]:
+                    if not p.is_alive():
+                        LOGGER.info('Retired process %s exited', p.pid)
+                        p.join()
+                        draining.remove(p)
+
                 # Exit if not restarting and no live workers.
                 if not options['restart']:
                     if not any([p.is_alive() for p in pool]):
@@ -171,7 +493,9 @@ class Command(BaseCommand):
         except KeyboardInterrupt:
             LOGGER.info('Received KeyboardInterrupt')
 
-        for p in pool:
+        if rolling is not None:
+            draining.extend(rolling.abandon())
+        for p in pool + draining:
             LOGGER.info('Requesting %s shutdown', p.pid)
             p.terminate()
             p.join()
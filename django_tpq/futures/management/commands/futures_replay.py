@@ -0,0 +1,27 @@
+from __future__ import absolute_import
+
+from django.core.management.base import BaseCommand
+
+from futures.futures import FUTURES_DEAD_LETTER_QUEUE, get_queue_model
+
+
+class Command(BaseCommand):
+    """
+    Replay dead futures.
+    """
+
+    help = 'Move futures from the dead-letter queue back onto their queues.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--queue_name',
+                            default=FUTURES_DEAD_LETTER_QUEUE,
+                            help='The dead-letter queue. default: %s' %
+                            FUTURES_DEAD_LETTER_QUEUE)
+        parser.add_argument('--limit', type=int, default=None,
+                            help='Maximum number of futures to replay. '
+                                 'default: all')
+
+    def handle(self, *args, **options):
+        Model = get_queue_model(options['queue_name'])
+        count = Model.objects.replay(limit=options['limit'])
+        self.stdout.write('Replayed %s futures' % count)
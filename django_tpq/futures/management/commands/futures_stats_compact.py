@@ -0,0 +1,41 @@
+from __future__ import absolute_import
+
+import logging
+
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from futures.models import FutureStatHistory
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    """
+    Downsample and expire future statistics history.
+    """
+
+    help = 'Merge old per-minute statistics into hourly buckets and delete ' \
+           'expired hourly buckets.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--minute-buckets-hours', type=int, default=24,
+                            help='Hours of per-minute buckets to keep. '
+                                 'default: 24')
+        parser.add_argument('--hour-buckets-days', type=int, default=30,
+                            help='Days of hourly buckets to keep. '
+                                 'default: 30')
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+
+        written = FutureStatHistory.objects.downsample(
+            now - timedelta(hours=options['minute_buckets_hours']))
+        LOGGER.info('Wrote %s hourly buckets', written)
+
+        deleted = FutureStatHistory.objects.expire(
+            now - timedelta(days=options['hour_buckets_days']))
+        LOGGER.info('Deleted %s hourly buckets', deleted)
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('futures', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='futurestat',
+            name='first_seen',
+            field=models.DateTimeField(auto_now_add=True),
+        ),
+        migrations.CreateModel(
+            name='FutureStatHistory',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=256)),
+                ('start', models.DateTimeField(db_index=True)),
+                ('period', models.IntegerField(default=60)),
+                ('total', models.IntegerField(default=0)),
+                ('failed', models.IntegerField(default=0)),
+                ('time_total', models.FloatField(default=0)),
+                ('time_max', models.FloatField(default=0)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='futurestathistory',
+            unique_together=set([('name', 'start', 'period')]),
+        ),
+    ]
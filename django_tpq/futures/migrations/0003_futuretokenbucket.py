@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('futures', '0002_futurestathistory'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FutureTokenBucket',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=256, unique=True)),
+                ('tokens', models.FloatField()),
+                ('updated', models.DateTimeField()),
+            ],
+        ),
+    ]
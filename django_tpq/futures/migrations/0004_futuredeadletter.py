@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+
+import tpq
+
+
+def forwards(apps, schema_editor):
+    with tpq.Queue('futures_futuredeadletter',
+                   conn=schema_editor.connection) as q:
+        q.create()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('futures', '0003_futuretokenbucket'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FutureDeadLetter',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('data', django.contrib.postgres.fields.jsonb.JSONField()),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.RunPython(forwards, hints={'model_name': 'FutureDeadLetter'})
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    # Building concurrently does not block the queue, but cannot be done in
+    # a transaction.
+    atomic = False
+
+    dependencies = [
+        ('futures', '0004_futuredeadletter'),
+    ]
+
+    operations = [
+        # Allows purging or inspecting the futures of a single name.
+        migrations.RunSQL(
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS "
+            "tpq_futures_futurequeue_name_idx "
+            "ON tpq_futures_futurequeue ((data->>'name'))",
+            "DROP INDEX CONCURRENTLY IF EXISTS "
+            "tpq_futures_futurequeue_name_idx",
+        ),
+    ]
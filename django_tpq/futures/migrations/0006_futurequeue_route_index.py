@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('futures', '0005_futurequeue_name_index'),
+    ]
+
+    operations = [
+        # Allows executors to find the oldest future on their routes.
+        migrations.RunSQL(
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS "
+            "tpq_futures_futurequeue_route_idx "
+            "ON tpq_futures_futurequeue ((data->>'route'), id)",
+            "DROP INDEX CONCURRENTLY IF EXISTS "
+            "tpq_futures_futurequeue_route_idx",
+        ),
+    ]
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('futures', '0006_futurequeue_route_index'),
+    ]
+
+    operations = [
+        # Version 2 messages identify futures by id rather than name.
+        migrations.RunSQL(
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS "
+            "tpq_futures_futurequeue_id_idx "
+            "ON tpq_futures_futurequeue ((data->>'f'))",
+            "DROP INDEX CONCURRENTLY IF EXISTS "
+            "tpq_futures_futurequeue_id_idx",
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('futures', '0007_futurequeue_id_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='futurestat',
+            name='retried',
+            field=models.IntegerField(default=0),
+        ),
+    ]
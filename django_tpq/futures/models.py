@@ -1,8 +1,31 @@
 from __future__ import absolute_import
 
-from django.db import models
+from django.apps import apps
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import connections, models
+from django.db.transaction import atomic
 
-from main.models import BaseQueue
+from psycopg2.extras import execute_values
+
+from main.models import BaseQueue, BaseQueueManager
+
+
+class FutureQueueManager(BaseQueueManager):
+    """
+    Manage the futures queue.
+    """
+
+    def _match(self, name=None, where=None):
+        """
+        Match futures by name, whether messages name them or use their id.
+        """
+        clause, params = super(FutureQueueManager, self)._match(where=where)
+        if name is None:
+            return clause, params
+        from futures.futures import future_id
+        return "(data->>'name' = %s OR data->>'f' = %s) AND " + clause, \
+            [name, str(future_id(name))] + params
 
 
 class FutureQueue(BaseQueue):
@@ -10,7 +33,49 @@ class FutureQueue(BaseQueue):
     Queue to store futures.
     """
 
-    pass  # objects = FutureManager()
+    objects = FutureQueueManager()
+
+    high_water = getattr(settings, 'FUTURES_HIGH_WATER', None)
+    low_water = getattr(settings, 'FUTURES_LOW_WATER', None)
+    overload = getattr(settings, 'FUTURES_OVERLOAD', 'raise')
+    overload_timeout = getattr(settings, 'FUTURES_OVERLOAD_TIMEOUT', 10.0)
+    databases = getattr(settings, 'FUTURES_QUEUE_DATABASES', None)
+
+
+class FutureDeadLetterManager(BaseQueueManager):
+    """
+    Manage futures that failed after all retries.
+    """
+
+    def replay(self, limit=None):
+        """
+        Move up to `limit` dead futures back onto their original queues.
+
+        Retries start again from the first attempt. Returns the number of
+        futures replayed.
+        """
+        count = 0
+        while limit is None or count < limit:
+            with atomic(using=self.db):
+                try:
+                    d = self.dequeue()
+                except ObjectDoesNotExist:
+                    break
+                Model = apps.get_model(d['queue'])
+                Model.objects.enqueue(dict(d['message'], attempt=0))
+            count += 1
+        return count
+
+
+class FutureDeadLetter(BaseQueue):
+    """
+    Queue to store futures that failed after all retries.
+
+    Each item holds the original message, the label of its queue, the error
+    and the time of the final failure.
+    """
+
+    objects = FutureDeadLetterManager()
 
 
 class FutureStat(models.Model):
@@ -24,9 +89,127 @@ class FutureStat(models.Model):
     running = models.IntegerField(default=0)
     total = models.IntegerField(default=0)
     failed = models.IntegerField(default=0)
+    retried = models.IntegerField(default=0)
     last_seen = models.DateTimeField(auto_now=True)
-    first_seen = models.DateTimeField(auto_now=True)
+    first_seen = models.DateTimeField(auto_now_add=True)
 
     def update(self, **kwargs):
         """Shortcut to perform SQL UPDATE for instance."""
         FutureStat.objects.filter(pk=self.pk).update(**kwargs)
+
+
+class FutureStatHistoryManager(models.Manager):
+    """
+    Maintain time-bucketed statistics.
+    """
+
+    @atomic
+    def upsert(self, rows):
+        """
+        Add counts to buckets, creating them as needed.
+
+        rows is a dictionary mapping (name, start) to (total, failed,
+        time_total, time_max) for per-minute buckets. All rows are written
+        using a single statement.
+        """
+        values = [
+            (name, start, 60, total, failed, time_total, time_max)
+            for (name, start), (total, failed, time_total, time_max)
+            in rows.items()
+        ]
+        if not values:
+            return
+        table = self.model._meta.db_table
+        with connections[self.db].cursor() as cursor:
+            execute_values(cursor, UPSERT % {'table': table}, values,
+                           page_size=len(values))
+
+    @atomic
+    def downsample(self, before, period=60, to=3600):
+        """
+        Merge buckets of `period` seconds starting before `before` into
+        buckets of `to` seconds.
+
+        Returns the number of `to` second buckets written.
+        """
+        table = self.model._meta.db_table
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(DOWNSAMPLE % {'table': table}, {
+                'before': before,
+                'period': period,
+                'to': to,
+            })
+            return cursor.rowcount
+
+    def expire(self, before, period=3600):
+        """
+        Delete buckets of `period` seconds starting before `before`.
+        """
+        return self.filter(period=period, start__lt=before).delete()[0]
+
+
+UPSERT = """
+INSERT INTO %(table)s
+    (name, start, period, total, failed, time_total, time_max)
+VALUES %%s
+ON CONFLICT (name, start, period) DO UPDATE SET
+    total = %(table)s.total + EXCLUDED.total,
+    failed = %(table)s.failed + EXCLUDED.failed,
+    time_total = %(table)s.time_total + EXCLUDED.time_total,
+    time_max = GREATEST(%(table)s.time_max, EXCLUDED.time_max)
+"""
+
+DOWNSAMPLE = """
+WITH old AS (
+    DELETE FROM %(table)s
+    WHERE period = %%(period)s AND start < %%(before)s
+    RETURNING *
+)
+INSERT INTO %(table)s
+    (name, start, period, total, failed, time_total, time_max)
+SELECT name,
+       to_timestamp(floor(extract(epoch FROM start) / %%(to)s) * %%(to)s),
+       %%(to)s, SUM(total), SUM(failed), SUM(time_total), MAX(time_max)
+FROM old
+GROUP BY 1, 2
+ON CONFLICT (name, start, period) DO UPDATE SET
+    total = %(table)s.total + EXCLUDED.total,
+    failed = %(table)s.failed + EXCLUDED.failed,
+    time_total = %(table)s.time_total + EXCLUDED.time_total,
+    time_max = GREATEST(%(table)s.time_max, EXCLUDED.time_max)
+"""
+
+
+class FutureStatHistory(models.Model):
+    """
+    Time-bucketed execution statistics.
+
+    Buckets are per-minute when written by the executor. Older buckets are
+    merged into hourly buckets, then deleted, by the futures_stats_compact
+    command.
+    """
+
+    class Meta:
+        unique_together = ('name', 'start', 'period')
+
+    name = models.CharField(max_length=256)
+    start = models.DateTimeField(db_index=True)
+    # Bucket width in seconds.
+    period = models.IntegerField(default=60)
+    total = models.IntegerField(default=0)
+    failed = models.IntegerField(default=0)
+    # Execution time in seconds.
+    time_total = models.FloatField(default=0)
+    time_max = models.FloatField(default=0)
+
+    objects = FutureStatHistoryManager()
+
+
+class FutureTokenBucket(models.Model):
+    """
+    Token bucket used to rate limit a future across all executors.
+    """
+
+    name = models.CharField(max_length=256, unique=True)
+    tokens = models.FloatField()
+    updated = models.DateTimeField()
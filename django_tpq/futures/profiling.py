@@ -0,0 +1,121 @@
+"""
+Sampling profiler and slow log for Future executions.
+
+A fraction of executions are run under cProfile, statistics are aggregated
+per future name and written as pstats files that can be loaded with
+`python -m pstats`. Only executions in executor threads are profiled, those
+with a timeout or executor='process' run in other processes. Executions of
+any kind slower than a threshold are logged to the "futures.slow" logger.
+"""
+from __future__ import absolute_import
+
+import cProfile
+import json
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+
+
+LOGGER = logging.getLogger(__name__)
+SLOW_LOGGER = logging.getLogger('futures.slow')
+
+# Seconds between writing aggregated statistics.
+DUMP_INTERVAL = 60.0
+
+
+class Profiler(object):
+    """
+    Profile a fraction of executions and log slow ones.
+
+    `rate` is the fraction (0 to 1) of executions profiled, statistics are
+    written to `directory`. Executions taking longer than `slow` seconds,
+    not counting time waiting in the queue, are logged, 0 disables the slow
+    log.
+    """
+
+    def __init__(self, rate=0.0, directory=None, slow=0.0):
+        self.configure(rate, directory, slow)
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.dumped = time.time()
+
+    def configure(self, rate=0.0, directory=None, slow=0.0):
+        if rate and not directory:
+            raise ValueError('A directory is required for profiling')
+        self.rate = rate
+        self.directory = directory
+        self.slow = slow
+
+    def sample(self):
+        """
+        Return True if this execution should be profiled.
+        """
+        return self.rate > 0 and random.random() < self.rate
+
+    def profile(self, name, f, args, kwargs):
+        """
+        Call f under cProfile, adding its statistics to those for `name`.
+        """
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(f, *args, **kwargs)
+        finally:
+            with self.lock:
+                if name in self.stats:
+                    self.stats[name].add(profile)
+                else:
+                    self.stats[name] = pstats.Stats(profile)
+            if time.time() - self.dumped >= DUMP_INTERVAL:
+                self.dump()
+
+    def dump(self):
+        """
+        Write aggregated statistics, one file per future name.
+
+        Files are named <name>.<pid>.pstats so that executor processes do not
+        overwrite one another.
+        """
+        with self.lock:
+            self.dumped = time.time()
+            for name, stats in self.stats.items():
+                path = os.path.join(self.directory,
+                                    '%s.%s.pstats' % (name, os.getpid()))
+                try:
+                    stats.dump_stats(path)
+                except OSError as e:
+                    LOGGER.warning('Could not write %s: %s', path, e)
+
+    def log_slow(self, name, message, timings):
+        """
+        Log an execution if it took longer than the threshold.
+
+        Queue wait is reported but not counted, otherwise every execution
+        is slow during a backlog.
+        """
+        if not self.slow:
+            return
+        elapsed = sum(v for k, v in timings.items() if k != 'wait')
+        if elapsed < self.slow:
+            return
+        SLOW_LOGGER.warning(
+            'Future "%s" took %.3fs: wait %.3fs, deserialize %.3fs, run '
+            '%.3fs, serialize %.3fs, arguments %s bytes',
+            name, elapsed, timings.get('wait', 0),
+            timings.get('deserialize', 0), timings.get('run', 0),
+            timings.get('serialize', 0), _size(message.get('p')) +
+            _size(message.get('args')) + _size(message.get('kwargs')))
+
+
+def _size(data):
+    if data is None:
+        return 0
+    if isinstance(data, str):
+        return len(data)
+    return len(json.dumps(data))
+
+
+PROFILER = Profiler()
+configure = PROFILER.configure
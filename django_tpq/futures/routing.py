@@ -0,0 +1,64 @@
+"""
+Affinity routing of futures to executor processes.
+
+Futures declared with a routing_key have each message assigned to one of
+FUTURES_ROUTE_BUCKETS routes by hashing its key. Executor processes divide the
+routes between them using a consistent hash ring over their slot indexes, so
+messages with the same key go to the same process (or small group of
+processes), and few routes move when the pool is resized.
+"""
+from __future__ import absolute_import
+
+import bisect
+import hashlib
+
+from django.conf import settings
+
+
+ROUTE_BUCKETS = getattr(settings, 'FUTURES_ROUTE_BUCKETS', 1024)
+# Points per slot on the ring, more gives a more even spread.
+REPLICAS = 64
+
+
+def _hash(s):
+    return int(hashlib.md5(s.encode('utf8')).hexdigest()[:8], 16)
+
+
+def route(key):
+    """
+    Return the route for a routing key.
+    """
+    return _hash(str(key)) % ROUTE_BUCKETS
+
+
+class HashRing(object):
+    """
+    Consistent hash ring mapping routes to executor slots.
+    """
+
+    def __init__(self, slots, replicas=REPLICAS):
+        self.ring = sorted((_hash('%s-%s' % (slot, i)), slot)
+                           for slot in slots for i in range(replicas))
+        self.points = [point for point, _ in self.ring]
+        self.slots = len(set(slots))
+
+    def owners(self, route, group=1):
+        """
+        Return the `group` slots that own a route.
+        """
+        group = min(group, self.slots)
+        i = bisect.bisect(self.points, _hash(str(route)))
+        owners = []
+        while len(owners) < group:
+            slot = self.ring[i % len(self.ring)][1]
+            if slot not in owners:
+                owners.append(slot)
+            i += 1
+        return owners
+
+    def routes(self, slot, group=1):
+        """
+        Return the routes owned by a slot.
+        """
+        return [r for r in range(ROUTE_BUCKETS)
+                if slot in self.owners(r, group)]
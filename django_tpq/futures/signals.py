@@ -0,0 +1,15 @@
+"""
+Signals sent by the executor.
+
+Connect to these to attach tracing or metrics to future executions.
+"""
+from django.dispatch import Signal
+
+
+# Sent before a future is called.
+pre_execute = Signal(providing_args=['future', 'message'])
+
+# Sent after a future is called and its result stored. timings is a dictionary
+# of durations in seconds: wait (in queue), deserialize, run and serialize.
+post_execute = Signal(providing_args=['future', 'message', 'failed',
+                                      'timings'])
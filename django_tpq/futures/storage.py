@@ -0,0 +1,144 @@
+"""
+File-backed storage for large Future results.
+
+Large results are written to a directory shared by executors and callers
+(local or NFS) instead of being pickled into the cache. Only a reference is
+placed in the cache. Callers receive a memory-mapped view or an open file
+rather than a copy of the data.
+"""
+from __future__ import absolute_import
+
+import logging
+import mmap
+import os
+import shutil
+import tempfile
+import time
+
+import dill
+
+from django.conf import settings
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+LOGGER = logging.getLogger(__name__)
+
+RESULT_DIR = getattr(settings, 'FUTURES_RESULT_DIR', None)
+# Results at least this many bytes are stored in RESULT_DIR, if set.
+RESULT_FILE_THRESHOLD = getattr(settings, 'FUTURES_RESULT_FILE_THRESHOLD',
+                                16 * 1024 * 1024)
+
+
+def _size(obj):
+    """
+    Return the size in bytes of obj if it can be stored without pickling.
+    """
+    if isinstance(obj, (bytes, bytearray)):
+        return len(obj)
+    if isinstance(obj, memoryview):
+        return obj.nbytes
+    if numpy is not None and isinstance(obj, numpy.ndarray):
+        return obj.nbytes
+
+
+def _kind(obj):
+    if numpy is not None and isinstance(obj, numpy.ndarray):
+        return 'numpy'
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        return 'buffer'
+    if hasattr(obj, 'read'):
+        return 'stream'
+    return 'dill'
+
+
+def wants_file(obj):
+    """
+    Return True if obj is large enough to be stored as a file.
+    """
+    if not RESULT_DIR:
+        return False
+    if hasattr(obj, 'read'):
+        # Streams cannot be pickled anyway.
+        return True
+    size = _size(obj)
+    return size is not None and size >= RESULT_FILE_THRESHOLD
+
+
+def save(uid, obj):
+    """
+    Write obj to a file, returning a reference for load().
+
+    Buffers and numpy arrays are written raw, file-like objects are copied in
+    chunks and anything else is pickled directly to the file.
+    """
+    kind = _kind(obj)
+    fd, tmp = tempfile.mkstemp(prefix='.%s-' % uid, dir=RESULT_DIR)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            if kind == 'numpy':
+                numpy.save(f, obj, allow_pickle=False)
+            elif kind == 'buffer':
+                f.write(obj)
+            elif kind == 'stream':
+                shutil.copyfileobj(obj, f)
+            else:
+                dill.dump(obj, f)
+        path = os.path.join(RESULT_DIR, '%s.%s' % (uid, kind))
+        # Readers never see a partial file.
+        os.rename(tmp, path)
+    except Exception:
+        os.remove(tmp)
+        raise
+    return {'path': path, 'kind': kind}
+
+
+def load(ref):
+    """
+    Open a file written by save().
+
+    Returns a read-only memoryview of a memory map for buffers, a
+    memory-mapped array for numpy arrays, an open binary file for streams, or
+    the unpickled object. The file is unlinked once opened, its storage is
+    freed when the returned object is released.
+    """
+    path, kind = ref['path'], ref['kind']
+    try:
+        if kind == 'numpy':
+            return numpy.load(path, mmap_mode='r', allow_pickle=False)
+        elif kind == 'buffer':
+            with open(path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return memoryview(b'')
+                return memoryview(mmap.mmap(f.fileno(), 0,
+                                            access=mmap.ACCESS_READ))
+        elif kind == 'stream':
+            return open(path, 'rb')
+        else:
+            with open(path, 'rb') as f:
+                return dill.load(f)
+    finally:
+        os.remove(path)
+
+
+def cleanup(max_age=settings.FUTURES_CACHE_TTL):
+    """
+    Remove result files older than max_age seconds.
+
+    Their cache entries have expired, so they will never be read.
+    """
+    if not RESULT_DIR:
+        return
+    cutoff = time.time() - max_age
+    for name in os.listdir(RESULT_DIR):
+        path = os.path.join(RESULT_DIR, name)
+        try:
+            if os.stat(path).st_mtime < cutoff:
+                os.remove(path)
+                LOGGER.debug('Removed expired result %s', name)
+        except FileNotFoundError:
+            # Read or removed by someone else.
+            pass
@@ -0,0 +1,50 @@
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+
+import mock
+
+from django.test import TestCase
+
+from futures import affinity
+
+
+class AffinityTestCase(TestCase):
+    def setUp(self):
+        # Two nodes of four CPUs, as sysfs presents them.
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        for node, cpus in ((0, '0-3'), (1, '4-7')):
+            os.mkdir(os.path.join(self.path, 'node%s' % node))
+            with open(os.path.join(self.path, 'node%s' % node,
+                                   'cpulist'), 'w') as f:
+                f.write('%s\n' % cpus)
+        for patcher in (mock.patch('futures.affinity.NODE_PATH', self.path),
+                        mock.patch('futures.affinity.available_cpus',
+                                   return_value=list(range(8)))):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_parse(self):
+        self.assertEqual([0, 1, 2, 3, 8, 10, 11],
+                         affinity.parse_cpus('8,0-3, 10-11'))
+        with self.assertRaises(ValueError):
+            affinity.parse_cpus('0-3,x')
+
+    def test_numa_nodes(self):
+        self.assertEqual([[0, 1, 2, 3], [4, 5, 6, 7]], affinity.numa_nodes())
+        self.assertEqual([[2, 3], [4]], affinity.numa_nodes([2, 3, 4]))
+
+    def test_plan(self):
+        """Ensure processes are spread across NUMA nodes."""
+        self.assertEqual([[0, 1, 2, 3], [4, 5, 6, 7], [0, 1, 2, 3]],
+                         affinity.plan('auto', 3))
+        self.assertEqual([[0], [4], [1]], affinity.plan('per-process', 3))
+        self.assertEqual([[0, 1], [0, 1]], affinity.plan('0-1', 2))
+
+        with self.assertRaises(ValueError):
+            affinity.plan('per-process', 9)
+        with self.assertRaises(ValueError):
+            affinity.plan('0-8', 2)
@@ -3,10 +3,16 @@ import time
 import threading
 import unittest
 
+import mock
+
+from django.core.exceptions import ObjectDoesNotExist
 from django.core.management import call_command
 from django.test import TransactionTestCase
 
 from futures.decorators import future
+from futures.management.commands.futures_executor import (
+    Promoter, Recycler, RollingRestart, executor_t
+)
 from futures.models import FutureStat
 
 
@@ -15,6 +21,161 @@ def foo(a, b):
     return a + b
 
 
+class TestRecycler(unittest.TestCase):
+    """
+    Test process recycling limits.
+    """
+
+    def test_max_tasks(self):
+        stopping, retiring = threading.Event(), threading.Event()
+        recycler = Recycler(stopping, retiring, max_tasks=2)
+
+        recycler.done()
+        self.assertFalse(stopping.is_set())
+
+        recycler.done()
+        self.assertTrue(stopping.is_set())
+        self.assertTrue(retiring.is_set())
+
+    @mock.patch('futures.management.commands.futures_executor.get_rss')
+    def test_max_rss(self, get_rss):
+        stopping, retiring = threading.Event(), threading.Event()
+        recycler = Recycler(stopping, retiring, max_rss=512)
+
+        get_rss.return_value = 256
+        recycler.done()
+        self.assertFalse(retiring.is_set())
+
+        get_rss.return_value = 1024
+        recycler.done()
+        self.assertTrue(stopping.is_set())
+        self.assertTrue(retiring.is_set())
+
+
+class TestPromoter(unittest.TestCase):
+    """
+    Test promotion is shared by a process's threads.
+    """
+
+    def test_interval(self):
+        Model = mock.Mock()
+        promoter = Promoter(Model, interval=60)
+
+        promoter.maybe_promote()
+        promoter.maybe_promote()
+        self.assertEqual(1, Model.objects.promote.call_count)
+
+        promoter.promoted -= 60
+        promoter.maybe_promote()
+        self.assertEqual(2, Model.objects.promote.call_count)
+
+
+class TestRollingRestart(unittest.TestCase):
+    """
+    Test replacing processes a batch at a time.
+    """
+
+    def _process(self, slot=None):
+        p = mock.Mock(pid=slot)
+        p.ready = threading.Event()
+        p.is_alive.return_value = True
+        return p
+
+    def test_restart(self):
+        pool = [self._process(i) for i in range(3)]
+        old = list(pool)
+        rolling = RollingRestart(range(3), batch=2)
+
+        rolling.step(pool, self._process)
+        # Replacements are started first, old processes keep running.
+        self.assertEqual([pool[0], pool[1], old[2]], pool)
+        self.assertFalse(old[0].terminate.called)
+
+        # Once ready, the old process drains and the next slot starts only
+        # after it has exited.
+        pool[0].ready.set()
+        rolling.step(pool, self._process)
+        old[0].terminate.assert_called_once_with()
+        self.assertIs(old[2], pool[2])
+
+        old[0].is_alive.return_value = False
+        rolling.step(pool, self._process)
+        self.assertIsNot(old[2], pool[2])
+
+        for p in pool:
+            p.ready.set()
+        rolling.step(pool, self._process)
+        for p in old:
+            p.is_alive.return_value = False
+        rolling.step(pool, self._process)
+        self.assertTrue(rolling.done())
+
+    def test_restarted(self):
+        """Ensure a replacement restarted by the supervisor is tracked."""
+        pool = [self._process(i) for i in range(1)]
+        old = list(pool)
+        rolling = RollingRestart(range(1))
+
+        rolling.step(pool, self._process)
+        # The replacement dies and the supervisor restarts it.
+        pool[0].is_alive.return_value = False
+        restarted = pool[0] = self._process()
+
+        rolling.step(pool, self._process)
+        self.assertIs(restarted, pool[0])
+        self.assertFalse(old[0].terminate.called)
+
+        restarted.ready.set()
+        rolling.step(pool, self._process)
+        self.assertIs(restarted, pool[0])
+        old[0].terminate.assert_called_once_with()
+
+    def test_failed(self):
+        """Ensure old processes are kept if their replacement dies."""
+        pool = [self._process(i) for i in range(2)]
+        old = list(pool)
+        rolling = RollingRestart(range(2))
+
+        rolling.step(pool, self._process)
+        pool[0].is_alive.return_value = False
+        rolling.step(pool, self._process)
+
+        self.assertEqual(old, pool)
+        self.assertFalse(old[0].terminate.called)
+        self.assertTrue(rolling.done())
+
+
+class TestExecutorThread(unittest.TestCase):
+    """
+    Test executor threads.
+    """
+
+    @mock.patch('futures.management.commands.futures_executor.STOP_INTERVAL',
+                0.1)
+    def test_idle_stop(self):
+        """Ensure an idle thread waiting forever still stops when asked."""
+        waits = []
+
+        def _dequeue(wait=-1, routes=None):
+            waits.append(wait)
+            # An empty queue, as tpq waits.
+            time.sleep(wait if wait > 0 else 10)
+            raise ObjectDoesNotExist
+
+        Model = mock.Mock()
+        Model.objects.dequeue.side_effect = _dequeue
+        stopping = threading.Event()
+        t = threading.Thread(target=executor_t, args=(Model, stopping),
+                             kwargs={'wait': 0})
+        t.start()
+
+        time.sleep(0.2)
+        stopping.set()
+        t.join(2)
+        self.assertFalse(t.is_alive())
+        self.assertEqual({0.1}, set(waits))
+
+
 # We use TransactionTestCase to ensure our queue is visible to another
 # connection/thread/process.
 class TestExecutor(TransactionTestCase):
@@ -1,18 +1,35 @@
 from __future__ import absolute_import
 
+import asyncio
+import os
+import time
+
+from datetime import timedelta
+
 import mock
 
 from django.conf import settings
-from django.core.exceptions import ObjectDoesNotExist
-from django.test import TestCase
+from django.core.exceptions import ImproperlyConfigured, ObjectDoesNotExist
+from django.db import OperationalError, connection
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
 
 import tpq
 
-from futures.models import FutureQueue, FutureStat
+from main import models as main_models
+from main.models import DelayedMessage, QueueFull
+from futures.models import (
+    FutureDeadLetter, FutureQueue, FutureStat, FutureStatHistory
+)
 from futures.futures import (
-    Future, FutureResult, JSONSerializer
+    Future, FutureResult, FutureTimeout, JSONSerializer, ResultNotStored,
+    STATS, StatsBuffer, UnknownFuture, as_completed, future_id, gather,
+    get_process_pool, message_uid, register
 )
+from futures import aio
 from futures.decorators import future
+from futures.executor import ResultListener, TPQExecutor, get_listener
+from futures.signals import post_execute
 
 
 FAKE_QUEUE = {}
@@ -45,6 +62,21 @@ def bar(a, b):
     return a / 0
 
 
+def baz(a, b):
+    """
+    Runaway function.
+    """
+    time.sleep(60)
+    return a + b
+
+
+def qux(a, b):
+    """
+    Crashing function.
+    """
+    os._exit(1)
+
+
 class FutureTestCase(TestCase):
     def test_decorator(self):
         # Create a function for testing.
@@ -128,6 +160,70 @@ class FutureTestCase(TestCase):
         # Ensure no result is available.
         self.assertIsNone(r.result(wait=0.1))
 
+    @mock.patch('tpq.put', mock_put)
+    @mock.patch('tpq.get', mock_get)
+    def test_envelope(self):
+        """Ensure compact messages identify the future by id."""
+        f_foo = future()(foo)
+
+        with mock.patch('futures.futures.MESSAGE_VERSION', 2):
+            r = f_foo.async(3, b=6)
+        m = FutureQueue.objects.dequeue()
+        self.assertEqual({'v', 'f', 'u', 't', 'p'}, set(m))
+        self.assertEqual(future_id(f_foo.name), m['f'])
+        self.assertEqual(r.uid, m['u'])
+
+        Future.execute(m)
+        self.assertEqual(9, r.result())
+
+    @mock.patch('tpq.put', mock_put)
+    @mock.patch('tpq.get', mock_get)
+    def test_envelope_v1(self):
+        """Ensure version 1 messages are still executed."""
+        f_foo = future(serializer=JSONSerializer)(foo)
+
+        r = f_foo.async(3, 6)
+        m = FutureQueue.objects.dequeue()
+        self.assertEqual(f_foo.name, m['name'])
+        self.assertEqual('[3, 6]', m['args'])
+
+        Future.execute(m)
+        self.assertEqual(9, r.result())
+
+    @mock.patch.dict('futures.futures.FUTURES_IDS')
+    def test_id_collision(self):
+        """Ensure futures with colliding ids are refused."""
+        f_foo, f_bar = future()(foo), Future(bar)
+        with mock.patch('futures.futures.future_id', return_value=1):
+            register(f_foo)
+            register(f_foo)
+            with self.assertRaises(ImproperlyConfigured):
+                register(f_bar)
+
+    @mock.patch('tpq.put', mock_put)
+    @mock.patch('tpq.get', mock_get)
+    def test_unknown(self):
+        """Ensure unknown futures fail fast."""
+        f_foo = future()(foo)
+
+        r = f_foo.async(3, 6)
+        m = FutureQueue.objects.dequeue()
+        m['name'] = 'futures.tests.test_futures.missing'
+        Future.execute(m)
+
+        with self.assertRaisesRegex(UnknownFuture, 'missing'):
+            r.result()
+
+        with mock.patch('futures.futures.MESSAGE_VERSION', 2):
+            r = f_foo.async(3, 6)
+        m = FutureQueue.objects.dequeue()
+        m['f'] = future_id('futures.tests.test_futures.missing')
+        Future.execute(m)
+
+        with self.assertRaisesRegex(UnknownFuture, 'Unknown future id %s' %
+                                    m['f']):
+            r.result()
+
     @mock.patch('tpq.put', mock_put)
     @mock.patch('tpq.get', mock_get)
     def test_exception(self):
@@ -149,12 +245,188 @@ class FutureTestCase(TestCase):
         with self.assertRaises(ZeroDivisionError):
             r.result()
 
+    @mock.patch('tpq.put', mock_put)
+    @mock.patch('tpq.get', mock_get)
+    def test_ignore_result(self):
+        """Ensure ignored results are never stored or waited on."""
+        f_foo = future(ignore_result=True)(foo)
+
+        r = f_foo.async(3, 6)
+        with mock.patch('futures.futures.set_result') as set_result:
+            Future.execute(FutureQueue.objects.dequeue())
+        self.assertFalse(set_result.called)
+
+        with self.assertRaises(ResultNotStored):
+            r.result(wait=-1)
+        with self.assertRaises(ResultNotStored):
+            gather([r], timeout=1)
+
+    @mock.patch('tpq.put', mock_put)
+    @mock.patch('tpq.get', mock_get)
+    def test_store_errors(self):
+        """Ensure only exceptions are stored for store='errors'."""
+        f_foo = future(store='errors')(foo)
+        f_bar = future(store='errors', result_ttl=60)(bar)
+
+        r_foo, r_bar = f_foo.async(3, 6), f_bar.async(3, 6)
+        with mock.patch('futures.futures.caches') as caches:
+            for _ in range(2):
+                Future.execute(FutureQueue.objects.dequeue())
+        cache = caches.__getitem__.return_value
+        self.assertEqual(1, cache.set.call_count)
+        key, _, ttl = cache.set.call_args[0]
+        self.assertEqual('futures:%s' % r_bar.uid, key)
+        self.assertEqual(60, ttl)
+
+        # Waiting forever is refused, a bounded wait is allowed.
+        with self.assertRaises(ResultNotStored):
+            r_foo.result(wait=-1)
+        self.assertIsNone(r_foo.result(wait=0.1))
+
+    @mock.patch('tpq.put', mock_put)
+    @mock.patch('tpq.get', mock_get)
+    def test_timeout(self):
+        """Ensure runaway futures are killed."""
+        f_foo = future(timeout=10)(foo)
+        f_bar = future(timeout=10)(bar)
+        f_baz = future(timeout=0.1)(baz)
+
+        r_foo, r_bar, r_baz = [f.async(3, 6) for f in (f_foo, f_bar, f_baz)]
+        for _ in range(3):
+            Future.execute(FutureQueue.objects.dequeue())
+
+        self.assertEqual(9, r_foo.result())
+        with self.assertRaises(ZeroDivisionError):
+            r_bar.result()
+        with self.assertRaises(FutureTimeout):
+            r_baz.result()
+
+        stat = FutureStat.objects.get(name=f_baz.name)
+        self.assertEqual(1, stat.failed)
+        self.assertEqual(0, stat.running)
+
+    @mock.patch('tpq.put', mock_put)
+    @mock.patch('tpq.get', mock_get)
+    def test_process(self):
+        """Ensure futures can run in the process pool."""
+        f_foo = future(executor='process')(foo)
+        f_bar = future(executor='process')(bar)
+
+        r_foo, r_bar = f_foo.async(3, 6), f_bar.async(3, 6)
+        Future.execute(FutureQueue.objects.dequeue())
+        Future.execute(FutureQueue.objects.dequeue())
+
+        self.assertEqual(9, r_foo.result())
+        with self.assertRaises(ZeroDivisionError):
+            r_bar.result()
+
+        with self.assertRaises(ValueError):
+            future(executor='fiber')(foo)
+
+    @mock.patch('tpq.put', mock_put)
+    @mock.patch('tpq.get', mock_get)
+    @mock.patch('futures.futures._PROCESS_POOL', (None, None))
+    @mock.patch('concurrent.futures.ProcessPoolExecutor',
+                side_effect=TypeError)
+    @mock.patch('threading.active_count', return_value=2)
+    def test_process_threads(self, *mocks):
+        """Ensure no pool is forked from a threaded process."""
+        self.assertIsNone(get_process_pool())
+
+        # Calls run in a child of the forkserver instead.
+        f_foo = future(executor='process')(foo)
+        r_foo = f_foo.async(3, 6)
+        Future.execute(FutureQueue.objects.dequeue())
+        self.assertEqual(9, r_foo.result())
+
+    @mock.patch('tpq.put', mock_put)
+    @mock.patch('tpq.get', mock_get)
+    def test_process_broken(self):
+        """Ensure the pool is replaced when a worker dies."""
+        f_foo = future(executor='process')(foo)
+        r_foo = f_foo.async(3, 6)
+        Future.execute(FutureQueue.objects.dequeue())
+        self.assertEqual(9, r_foo.result())
+
+        # Registered after the pool started.
+        f_qux = future(executor='process')(qux)
+        r_qux, r_foo = f_qux.async(3, 6), f_foo.async(3, 6)
+        Future.execute(FutureQueue.objects.dequeue())
+        Future.execute(FutureQueue.objects.dequeue())
+
+        with self.assertRaises(RuntimeError):
+            r_qux.result()
+        self.assertEqual(9, r_foo.result())
+
+    def test_retry(self):
+        """Ensure failed futures are retried once due, then dead-lettered."""
+        FutureQueue.objects.clear()
+        STATS.rows.clear()
+        f_bar = future(retries=2, backoff=60)(bar)
+        failed = []
+
+        def _receiver(signal, **kwargs):
+            failed.append(kwargs['failed'])
+
+        post_execute.connect(_receiver)
+        self.addCleanup(post_execute.disconnect, _receiver)
+
+        r = f_bar.async(3, 6)
+        Future.execute(FutureQueue.objects.dequeue())
+
+        # Two retries, no result until the final attempt.
+        for attempt in (1, 2):
+            self.assertIsNone(r.result())
+
+            # Held back until the backoff expires.
+            self.assertEqual(0, FutureQueue.objects.promote())
+            with self.assertRaises(ObjectDoesNotExist):
+                FutureQueue.objects.dequeue()
+
+            DelayedMessage.objects.update(
+                eta=timezone.now() - timedelta(days=1))
+            self.assertEqual(1, FutureQueue.objects.promote())
+            m = FutureQueue.objects.dequeue()
+            self.assertEqual(attempt, m['attempt'])
+            Future.execute(m)
+
+        with self.assertRaises(ZeroDivisionError):
+            r.result()
+
+        # Only the final attempt counts as failed.
+        stat = FutureStat.objects.get(name=f_bar.name)
+        self.assertEqual((3, 2, 1), (stat.total, stat.retried, stat.failed))
+        self.assertEqual([False, False, True], failed)
+        STATS.flush()
+        h = FutureStatHistory.objects.get(name=f_bar.name)
+        self.assertEqual((3, 1), (h.total, h.failed))
+
+        # The final failure is dead-lettered.
+        with self.assertRaises(ObjectDoesNotExist):
+            FutureQueue.objects.dequeue()
+        self.assertEqual(1, FutureDeadLetter.objects.replay())
+
+        m = FutureQueue.objects.dequeue()
+        self.assertEqual(r.uid, message_uid(m))
+        self.assertEqual(0, m['attempt'])
+
+    def test_retry_delay(self):
+        """Ensure retry delays back off exponentially."""
+        f_bar = future(retries=5, backoff=2)(bar)
+
+        self.assertLessEqual(f_bar.retry_delay(1), 2)
+        self.assertGreaterEqual(f_bar.retry_delay(3), 4)
+        self.assertLessEqual(f_bar.retry_delay(3), 8)
+
     @mock.patch('tpq.put', mock_put)
     @mock.patch('tpq.get', mock_get)
     def test_stat(self):
         f_foo = future()(foo)
         f_bar = future()(bar)
 
+        # Discard statistics buffered by other tests.
+        STATS.rows.clear()
+
         f_foo.async(3, 6)
         f_bar.async(3, 6)
 
@@ -172,3 +444,235 @@ class FutureTestCase(TestCase):
 
         self.assertEqual(0, s_foo.failed)
         self.assertEqual(1, s_bar.failed)
+
+        # Per-minute history is written in batches.
+        STATS.flush()
+        h_foo = FutureStatHistory.objects.get(name=f_foo.name)
+        h_bar = FutureStatHistory.objects.get(name=f_bar.name)
+
+        self.assertEqual(1, h_foo.total)
+        self.assertEqual(0, h_foo.failed)
+        self.assertEqual(1, h_bar.failed)
+        self.assertEqual(60, h_foo.period)
+
+    def test_stat_flush(self):
+        """Ensure buffered statistics are written once due."""
+        stats = StatsBuffer(interval=60)
+        stats.record('foo', False, 1.0)
+        stats.maybe_flush()
+        self.assertFalse(FutureStatHistory.objects.filter(name='foo').exists())
+
+        # As executor threads do while idle.
+        stats.flushed -= 60
+        stats.maybe_flush()
+        self.assertEqual(1, FutureStatHistory.objects.get(name='foo').total)
+        self.assertEqual({}, stats.rows)
+
+    @mock.patch('tpq.put', mock_put)
+    @mock.patch('tpq.get', mock_get)
+    def test_gather(self):
+        """Ensure many results can be collected at once."""
+        f_foo = future()(foo)
+
+        results = [f_foo.async(i, 1) for i in range(5)]
+
+        # Nothing has executed, so we should time out.
+        with self.assertRaises(TimeoutError):
+            gather(results, timeout=0.1)
+
+        for _ in results:
+            Future.execute(FutureQueue.objects.dequeue())
+
+        self.assertEqual([1, 2, 3, 4, 5], gather(results, timeout=1))
+
+        # Results are retained once fetched.
+        self.assertEqual(1, results[0].result())
+
+    @mock.patch('tpq.put', mock_put)
+    @mock.patch('tpq.get', mock_get)
+    def test_as_completed(self):
+        """Ensure results are yielded as they complete."""
+        f_foo = future()(foo)
+        f_bar = future()(bar)
+
+        r_foo, r_bar = f_foo.async(3, 6), f_bar.async(3, 6)
+
+        # Only the second future completes.
+        FutureQueue.objects.dequeue()
+        Future.execute(FutureQueue.objects.dequeue())
+
+        completed = []
+        with self.assertRaises(TimeoutError):
+            for r in as_completed([r_foo, r_bar], timeout=0.1):
+                completed.append(r)
+
+        self.assertEqual([r_bar], completed)
+        with self.assertRaises(ZeroDivisionError):
+            r_bar.result()
+
+
+class TPQExecutorTestCase(TransactionTestCase):
+    """
+    Test the concurrent.futures facade.
+
+    Uses TransactionTestCase so that result notifications are delivered.
+    """
+
+    @mock.patch('tpq.put', mock_put)
+    @mock.patch('tpq.get', mock_get)
+    def test_submit(self):
+        f_foo = future()(foo)
+        f_bar = future()(bar)
+        called = []
+
+        with TPQExecutor() as executor:
+            fs = [executor.submit(f_foo, 3, 6), executor.submit(f_bar, 3, 6)]
+            fs[0].add_done_callback(called.append)
+
+            # This part would be done in the daemon.
+            Future.execute(FutureQueue.objects.dequeue())
+            Future.execute(FutureQueue.objects.dequeue())
+
+            self.assertEqual(9, fs[0].result(timeout=10))
+            with self.assertRaises(ZeroDivisionError):
+                fs[1].result(timeout=10)
+
+        self.assertEqual([fs[0]], called)
+
+        # Cannot submit after shutdown.
+        with self.assertRaises(RuntimeError):
+            executor.submit(f_foo, 3, 6)
+
+    def test_unregistered(self):
+        with self.assertRaises(ValueError):
+            TPQExecutor().submit(lambda: None)
+
+    def test_overloaded(self):
+        """Ensure refused calls raise rather than never completing."""
+        f_foo = future()(foo)
+        watched = len(get_listener().watched)
+
+        with mock.patch.object(FutureQueue, 'high_water', 1), \
+                mock.patch.object(FutureQueue, 'overload', 'drop'), \
+                mock.patch.object(FutureQueue.objects, 'overloaded',
+                                  return_value=True):
+            with TPQExecutor() as executor:
+                with self.assertRaises(QueueFull):
+                    executor.submit(f_foo, 3, 6)
+                self.assertFalse(executor._pending)
+        self.assertEqual(watched, len(get_listener().watched))
+
+    def test_listener_failure(self):
+        """Ensure a listener that fails to start or dies is replaced."""
+        with mock.patch.object(ResultListener, '_connect',
+                               side_effect=OperationalError('down')):
+            with self.assertRaises(OperationalError):
+                get_listener()
+
+        listener = get_listener()
+        self.assertTrue(listener.is_alive())
+
+        with mock.patch.object(listener, 'is_alive', return_value=False):
+            self.assertIsNot(listener, get_listener())
+
+
+class AsyncTestCase(TransactionTestCase):
+    """
+    Test the asyncio API.
+
+    Uses TransactionTestCase so that the asynchronous connections see the
+    queued messages and result notifications.
+    """
+
+    def setUp(self):
+        FutureQueue.objects.clear()
+
+    tearDown = setUp
+
+    def test_asubmit(self):
+        f_foo = future()(foo)
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+
+        async def _test():
+            r = await f_foo.asubmit(3, 6)
+            self.assertIsInstance(r, FutureResult)
+
+            # Nothing has executed, so we should time out.
+            with self.assertRaises(TimeoutError):
+                await r.aresult(timeout=0.1)
+
+            # This part would be done in the daemon.
+            await loop.run_in_executor(
+                None, lambda: Future.execute(FutureQueue.objects.dequeue()))
+
+            self.assertEqual(9, await r.aresult(timeout=10))
+
+        loop.run_until_complete(_test())
+
+    def test_asubmit_overloaded(self):
+        """Ensure the overload policy applies to asynchronous producers."""
+        f_foo = future()(foo)
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        self.addCleanup(main_models._OVERLOADED.clear)
+        self.addCleanup(main_models._DEPTHS.clear)
+        main_models._DEPTHS.clear()
+
+        async def _test():
+            await f_foo.asubmit(3, 6)
+            await f_foo.asubmit(3, 6)
+            main_models._DEPTHS.clear()
+
+            with mock.patch.object(FutureQueue, 'high_water', 2), \
+                    mock.patch.object(FutureQueue, 'overload', 'raise'):
+                with self.assertRaises(QueueFull):
+                    await f_foo.asubmit(3, 6)
+
+                with mock.patch.object(FutureQueue, 'overload', 'drop'):
+                    self.assertIsNone(await f_foo.asubmit(3, 6))
+
+        loop.run_until_complete(_test())
+        self.assertEqual(2, FutureQueue.objects.count())
+
+    @mock.patch('futures.aio.RECONNECT_INTERVAL', 0.1)
+    def test_listener_reconnect(self):
+        """Ensure the listener recovers from losing its connection."""
+        f_foo = future()(foo)
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+
+        async def _test():
+            listener = aio.get_listener(loop)
+            await listener.start()
+            old = listener.connection.conn
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_terminate_backend(%s)',
+                               [old.get_backend_pid()])
+
+            for _ in range(50):
+                await asyncio.sleep(0.1, loop=loop)
+                if listener.connection.conn not in (None, old):
+                    break
+            self.assertNotIn(listener.connection.conn, (None, old))
+
+            # Notifications arrive on the new connection.
+            r = await f_foo.asubmit(3, 6)
+            await loop.run_in_executor(
+                None, lambda: Future.execute(FutureQueue.objects.dequeue()))
+            self.assertEqual(9, await r.aresult(timeout=10))
+
+        loop.run_until_complete(_test())
+
+    def test_closed_loops(self):
+        """Ensure entries for closed event loops are dropped."""
+        loop = asyncio.new_event_loop()
+        aio.get_connection('default', loop)
+        aio.get_listener(loop)
+        loop.close()
+
+        other = asyncio.new_event_loop()
+        self.addCleanup(other.close)
+        aio.get_listener(other)
+        self.assertNotIn(loop, aio._CONNECTIONS)
+        self.assertNotIn(loop, aio._LISTENERS)
@@ -1,6 +1,29 @@
-from django.test import TestCase
+import json
+import os
+import tempfile
+import time
+import unittest
 
-from futures.models import FutureQueue
+from datetime import timedelta
+from io import StringIO
+
+import mock
+
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import OperationalError, connection
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+
+import tpq
+
+from main import models as main_models
+from main.models import DelayedMessage, QueueFull, enqueue_batch
+from futures.decorators import future
+from futures.models import FutureQueue, FutureStatHistory
+from futures.tests.test_futures import foo
 
 
 D = {'foo': 'foo'}
@@ -55,3 +78,419 @@ class TestModel(TestCase):
         FutureQueue.objects.enqueue(D)
         d = FutureQueue.objects.dequeue()
         self.assertEqual(D, d)
+
+    def test_delay(self):
+        """Test delayed items are held back until due."""
+        FutureQueue.objects.enqueue(D, delay=60)
+
+        # Not yet due.
+        self.assertEqual(0, FutureQueue.objects.promote())
+        with self.assertRaises(ObjectDoesNotExist):
+            FutureQueue.objects.dequeue()
+
+        DelayedMessage.objects.update(eta=timezone.now())
+        self.assertEqual(1, FutureQueue.objects.promote())
+        self.assertEqual(D, FutureQueue.objects.dequeue())
+
+
+class TestBatch(TransactionTestCase):
+    """
+    Test enqueue batching.
+
+    Uses TransactionTestCase so that on_commit() callbacks are run.
+    """
+
+    def setUp(self):
+        FutureQueue.objects.clear()
+
+    tearDown = setUp
+
+    def test_batch(self):
+        """Test messages are written on commit."""
+        with mock.patch('tpq.put') as put:
+            with enqueue_batch():
+                FutureQueue.objects.enqueue(D)
+                FutureQueue.objects.enqueue(D)
+
+                # Nothing is written until commit.
+                with self.assertRaises(ObjectDoesNotExist):
+                    FutureQueue.objects.dequeue()
+
+        # Messages were written in bulk.
+        put.assert_not_called()
+        self.assertEqual(D, FutureQueue.objects.dequeue())
+        self.assertEqual(D, FutureQueue.objects.dequeue())
+
+    def test_rollback(self):
+        """Test messages are discarded on rollback."""
+        with self.assertRaises(ValueError):
+            with enqueue_batch():
+                FutureQueue.objects.enqueue(D)
+                raise ValueError()
+
+        with self.assertRaises(ObjectDoesNotExist):
+            FutureQueue.objects.dequeue()
+
+
+class TestStatHistory(TestCase):
+    """
+    Test the FutureStatHistory model.
+    """
+
+    def test_upsert(self):
+        """Test buckets are created then added to."""
+        start = timezone.now().replace(second=0, microsecond=0)
+        FutureStatHistory.objects.upsert({('foo', start): (1, 0, 1.0, 1.0)})
+        FutureStatHistory.objects.upsert({('foo', start): (2, 1, 3.0, 2.0)})
+
+        h = FutureStatHistory.objects.get(name='foo')
+        self.assertEqual(3, h.total)
+        self.assertEqual(1, h.failed)
+        self.assertEqual(4.0, h.time_total)
+        self.assertEqual(2.0, h.time_max)
+
+    def test_compact(self):
+        """Test old buckets are downsampled, then expired."""
+        hour = timezone.now().replace(minute=0, second=0, microsecond=0)
+        hour -= timedelta(days=1)
+        FutureStatHistory.objects.upsert({
+            ('foo', hour): (1, 0, 1.0, 1.0),
+            ('foo', hour + timedelta(minutes=1)): (1, 1, 2.0, 2.0),
+        })
+
+        FutureStatHistory.objects.downsample(hour + timedelta(hours=1))
+
+        h = FutureStatHistory.objects.get(name='foo')
+        self.assertEqual(3600, h.period)
+        self.assertEqual(hour, h.start)
+        self.assertEqual(2, h.total)
+        self.assertEqual(1, h.failed)
+        self.assertEqual(2.0, h.time_max)
+
+        FutureStatHistory.objects.expire(hour + timedelta(hours=1))
+        self.assertFalse(FutureStatHistory.objects.exists())
+
+    def test_compact_command(self):
+        """Test retention is given in the units of each bucket size."""
+        minute = timezone.now().replace(second=0, microsecond=0)
+        minute -= timedelta(hours=2)
+        FutureStatHistory.objects.upsert({('foo', minute): (1, 0, 1.0, 1.0)})
+
+        call_command('futures_stats_compact', minute_buckets_hours=3,
+                     hour_buckets_days=1)
+        self.assertEqual(60, FutureStatHistory.objects.get(name='foo').period)
+
+        call_command('futures_stats_compact', minute_buckets_hours=1,
+                     hour_buckets_days=1)
+        self.assertEqual(3600,
+                         FutureStatHistory.objects.get(name='foo').period)
+
+
+class TestMaintenance(TransactionTestCase):
+    """
+    Test the queue_maintenance command.
+
+    Uses TransactionTestCase as VACUUM cannot run within a transaction.
+    """
+
+    def test_report(self):
+        out = StringIO()
+        call_command('queue_maintenance', 'futures.FutureQueue',
+                     dry_run=True, stdout=out)
+        self.assertIn('futures.FutureQueue: ', out.getvalue())
+        self.assertNotIn('VACUUM', out.getvalue())
+
+    def _stats(self, until, timeout=5.0):
+        """
+        Wait for the statistics collector to catch up, returning the stats.
+        """
+        deadline = time.time() + timeout
+        while True:
+            stats = FutureQueue.objects.table_stats()
+            if until(stats) or time.time() >= deadline:
+                return stats
+            time.sleep(0.1)
+
+    def test_vacuum(self):
+        """Ensure dead tuples are vacuumed and indexes rebuilt."""
+        FutureQueue.objects.enqueue_many([D] * 200)
+        # Deleted rather than truncated, leaving dead tuples behind.
+        self.assertEqual(200, FutureQueue.objects.purge(where=D))
+        before = self._stats(lambda s: s['dead'] >= 200)
+        self.assertGreaterEqual(before['dead'], 200)
+
+        out = StringIO()
+        call_command('queue_maintenance', 'futures.FutureQueue',
+                     dead_ratio=0.5, min_dead=100, reindex_size=0,
+                     tune_autovacuum=100, stdout=out)
+        self.assertIn('futures.FutureQueue: VACUUM', out.getvalue())
+        self.assertIn('futures.FutureQueue: REINDEX', out.getvalue())
+
+        after = self._stats(lambda s: s['dead'] == 0 and s['last_vacuum'])
+        self.assertEqual(0, after['dead'])
+        self.assertIsNotNone(after['last_vacuum'])
+        self.assertLessEqual(after['index_size'], before['index_size'])
+
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT reloptions FROM pg_class '
+                           'WHERE relname = %s', [FutureQueue.objects.table])
+            self.assertIn('autovacuum_vacuum_threshold=100',
+                          cursor.fetchone()[0])
+
+    def test_thresholds(self):
+        """Ensure nothing is done below the thresholds."""
+        FutureQueue.objects.enqueue_many([D] * 10)
+        FutureQueue.objects.purge(where=D)
+        self._stats(lambda s: s['dead'] >= 10)
+
+        out = StringIO()
+        call_command('queue_maintenance', 'futures.FutureQueue',
+                     min_dead=1000, stdout=out)
+        self.assertNotIn('VACUUM', out.getvalue())
+        self.assertNotIn('REINDEX', out.getvalue())
+
+
+class TestLoad(TransactionTestCase):
+    """
+    Test the queue_load command.
+    """
+
+    def setUp(self):
+        FutureQueue.objects.clear()
+
+    tearDown = setUp
+
+    def test_load(self):
+        messages = [{'foo': 'tab\there'}, {'foo': 'back\\slash'}, D]
+        fd, path = tempfile.mkstemp()
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, 'wt') as f:
+            for m in messages:
+                f.write('%s\n\n' % json.dumps(m))
+
+        out = StringIO()
+        call_command('queue_load', 'futures.FutureQueue', path, chunk_size=2,
+                     stdout=out)
+        self.assertIn('3 rows', out.getvalue())
+
+        for m in messages:
+            self.assertEqual(m, FutureQueue.objects.dequeue())
+
+    def test_invalid(self):
+        fd, path = tempfile.mkstemp()
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, 'wt') as f:
+            f.write('[1, 2]\n')
+
+        with self.assertRaises(CommandError):
+            call_command('queue_load', 'futures.FutureQueue', path)
+
+
+class TestBackpressure(TestCase):
+    """
+    Test producer backpressure.
+    """
+
+    def setUp(self):
+        FutureQueue.objects.clear()
+        main_models._DEPTHS.clear()
+        main_models._OVERLOADED.clear()
+        for name, value in (('high_water', 3), ('low_water', 1),
+                            ('overload', 'raise'), ('overload_timeout', 0.1)):
+            patcher = mock.patch.object(FutureQueue, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _fill(self, n):
+        for i in range(n):
+            FutureQueue.objects.enqueue(D)
+        main_models._DEPTHS.clear()
+
+    def test_depth(self):
+        """Ensure the depth estimate is cached."""
+        self._fill(2)
+        self.assertEqual(2, FutureQueue.objects.depth())
+        FutureQueue.objects.enqueue(D)
+        self.assertEqual(2, FutureQueue.objects.depth())
+        self.assertEqual(3, FutureQueue.objects.depth(max_age=0))
+
+    def test_gaps(self):
+        """Ensure items taken from the middle do not hold the queue full."""
+        for i in range(5):
+            FutureQueue.objects.enqueue({'i': i})
+        for i in (1, 2, 3):
+            FutureQueue.objects.purge(where={'i': i})
+        main_models._DEPTHS.clear()
+
+        self.assertEqual(2, FutureQueue.objects.depth())
+        self.assertFalse(FutureQueue.objects.overloaded())
+        FutureQueue.objects.enqueue(D)
+
+    def test_raise(self):
+        """Ensure enqueue raises between the water marks."""
+        self._fill(3)
+        with self.assertRaises(QueueFull):
+            FutureQueue.objects.enqueue(D)
+
+        # Still overloaded until drained to the low water mark.
+        FutureQueue.objects.dequeue()
+        main_models._DEPTHS.clear()
+        with self.assertRaises(QueueFull):
+            FutureQueue.objects.enqueue(D)
+
+        # Delayed items are not refused.
+        FutureQueue.objects.enqueue(D, delay=60)
+
+        FutureQueue.objects.clear()
+        main_models._DEPTHS.clear()
+        FutureQueue.objects.enqueue(D)
+
+    def test_block(self):
+        """Ensure blocking producers time out."""
+        FutureQueue.overload = 'block'
+        self._fill(3)
+        with self.assertRaises(QueueFull):
+            FutureQueue.objects.enqueue(D)
+
+    def test_fallback(self):
+        """Ensure items are diverted or dropped."""
+        fallback = mock.Mock()
+        FutureQueue.overload = fallback
+        self._fill(3)
+        self.assertFalse(FutureQueue.objects.enqueue({'foo': 'bar'}))
+        fallback.assert_called_once_with({'foo': 'bar'})
+
+        FutureQueue.overload = 'drop'
+        self.assertFalse(FutureQueue.objects.enqueue(D))
+        main_models._DEPTHS.clear()
+        self.assertEqual(3, FutureQueue.objects.depth())
+
+        # Callers are not given a result that will never arrive.
+        self.assertIsNone(future()(foo).async(3, 6))
+
+
+class TestInspect(TransactionTestCase):
+    """
+    Test reading and purging pending items.
+    """
+
+    def setUp(self):
+        FutureQueue.objects.clear()
+        DelayedMessage.objects.all().delete()
+
+    tearDown = setUp
+
+    def _fill(self):
+        for i in range(5):
+            FutureQueue.objects.enqueue({'name': 'good', 'i': i})
+            FutureQueue.objects.enqueue({'name': 'bad', 'i': i})
+        FutureQueue.objects.enqueue({'name': 'bad', 'i': 5}, delay=60)
+
+    def test_peek(self):
+        self._fill()
+        items = [d for _, d in FutureQueue.objects.peek(3)]
+        self.assertEqual([{'name': 'good', 'i': 0}, {'name': 'bad', 'i': 0},
+                          {'name': 'good', 'i': 1}], items)
+
+        # Nothing is removed.
+        self.assertEqual(10, FutureQueue.objects.count())
+
+    def test_iter_pending(self):
+        self._fill()
+        items = [d['i'] for _, d in FutureQueue.objects.iter_pending(
+                 batch_size=2, name='bad')]
+        self.assertEqual([0, 1, 2, 3, 4], items)
+
+        items = [d for _, d in FutureQueue.objects.iter_pending(
+                 batch_size=2, where={'i': 3})]
+        self.assertEqual(2, len(items))
+
+    def test_purge(self):
+        self._fill()
+        with self.assertRaises(ValueError):
+            FutureQueue.objects.purge()
+
+        self.assertEqual(6, FutureQueue.objects.purge(name='bad',
+                                                      batch_size=2))
+        self.assertEqual(5, FutureQueue.objects.count())
+        self.assertEqual(0, DelayedMessage.objects.count())
+
+        self.assertEqual(1, FutureQueue.objects.purge(
+            where={'name': 'good', 'i': 4}))
+        self.assertEqual(4, FutureQueue.objects.count())
+
+    def test_commands(self):
+        self._fill()
+        out = StringIO()
+        call_command('queue_peek', 'futures.FutureQueue', limit=2,
+                     name='bad', stdout=out)
+        self.assertEqual([{'name': 'bad', 'i': 0}, {'name': 'bad', 'i': 1}],
+                         [json.loads(line) for line in
+                          out.getvalue().splitlines()])
+
+        with self.assertRaises(CommandError):
+            call_command('queue_purge', 'futures.FutureQueue')
+
+        out = StringIO()
+        call_command('queue_purge', 'futures.FutureQueue',
+                     where='{"name": "good"}', keep_delayed=True, stdout=out)
+        self.assertIn('Purged 5 items', out.getvalue())
+
+
+@unittest.skipUnless('node2' in settings.DATABASES,
+                     'Set NODE2_DATABASE_URL to test multiple databases')
+class TestMultiDatabase(TransactionTestCase):
+    """
+    Test queues spread across databases.
+    """
+
+    multi_db = True
+
+    def setUp(self):
+        patcher = mock.patch.object(FutureQueue, 'databases',
+                                    ['default', 'node2'])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        main_models._DOWN.clear()
+        FutureQueue.objects.clear()
+
+    def tearDown(self):
+        main_models._DOWN.clear()
+        FutureQueue.objects.clear()
+
+    def test_round_robin(self):
+        for i in range(4):
+            FutureQueue.objects.enqueue({'i': i})
+
+        self.assertEqual(4, FutureQueue.objects.count())
+        for alias in ('default', 'node2'):
+            self.assertEqual(2, FutureQueue.objects.db_manager(alias).count())
+
+        items = [FutureQueue.objects.dequeue(wait=-1)['i'] for i in range(4)]
+        self.assertEqual([0, 1, 2, 3], sorted(items))
+
+        # Returns at once when no database has an item.
+        with self.assertRaises(ObjectDoesNotExist):
+            FutureQueue.objects.dequeue(wait=-1)
+
+        # Waits, polling every database, until the deadline.
+        start = time.time()
+        with self.assertRaises(ObjectDoesNotExist):
+            FutureQueue.objects.dequeue(wait=1)
+        self.assertGreaterEqual(time.time() - start, 1)
+
+    def test_failover(self):
+        put = tpq.put
+
+        def _put(name, d, conn):
+            if conn.alias == 'node2':
+                raise OperationalError('unreachable')
+            return put(name, d, conn=conn)
+
+        with mock.patch('tpq.put', _put):
+            for i in range(4):
+                FutureQueue.objects.enqueue({'i': i})
+
+        self.assertEqual(4, FutureQueue.objects.db_manager('default').count())
+        self.assertIn('node2', main_models._DOWN)
+        self.assertEqual(['default'], FutureQueue.objects.nodes(healthy=True))
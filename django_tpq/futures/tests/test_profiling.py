@@ -0,0 +1,114 @@
+from __future__ import absolute_import
+
+import os
+import pstats
+import shutil
+import tempfile
+
+import mock
+
+from django.test import TestCase
+
+from futures import profiling
+from futures.decorators import future
+from futures.futures import Future
+from futures.models import FutureQueue
+from futures.signals import post_execute, pre_execute
+from futures.tests.test_futures import foo, mock_get, mock_put
+
+
+class ProfilingTestCase(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        patcher = mock.patch('futures.futures.PROFILER',
+                             profiling.Profiler(1.0, self.path, 0.0))
+        self.profiler = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @mock.patch('tpq.put', mock_put)
+    @mock.patch('tpq.get', mock_get)
+    def test_profile(self):
+        """Ensure sampled executions are aggregated per future."""
+        f_foo = future()(foo)
+
+        for i in range(3):
+            f_foo.async(i, 1)
+            Future.execute(FutureQueue.objects.dequeue())
+
+        self.profiler.dump()
+        path = os.path.join(self.path,
+                            '%s.%s.pstats' % (f_foo.name, os.getpid()))
+        stats = pstats.Stats(path)
+        calls = [v[1] for k, v in stats.stats.items() if k[2] == 'foo']
+        self.assertEqual([3], calls)
+
+    def test_sample(self):
+        """Ensure the rate limits profiled executions."""
+        self.assertTrue(self.profiler.sample())
+        self.profiler.configure(0.0)
+        self.assertFalse(self.profiler.sample())
+
+        with self.assertRaises(ValueError):
+            self.profiler.configure(0.5)
+
+    def test_slow(self):
+        """Ensure only slow executions are logged."""
+        self.profiler.configure(slow=1.0)
+        message = {'args': '[1, 2]', 'kwargs': '{}'}
+
+        with mock.patch('futures.profiling.SLOW_LOGGER') as logger:
+            self.profiler.log_slow('foo', message, {'run': 0.5})
+            self.assertFalse(logger.warning.called)
+
+            # Waiting in the queue does not make an execution slow.
+            self.profiler.log_slow('foo', message, {'wait': 5.0, 'run': 0.6})
+            self.assertFalse(logger.warning.called)
+
+            self.profiler.log_slow('foo', message, {'wait': 5.0, 'run': 0.6,
+                                                    'serialize': 0.5})
+            self.assertTrue(logger.warning.called)
+            args = logger.warning.call_args[0]
+            self.assertEqual('foo', args[1])
+            self.assertAlmostEqual(1.1, args[2])
+            self.assertEqual(5.0, args[3])
+            self.assertEqual(8, args[-1])
+
+    @mock.patch('tpq.put', mock_put)
+    @mock.patch('tpq.get', mock_get)
+    def test_process(self):
+        """Ensure futures in other processes are slow logged, not profiled."""
+        self.profiler.configure(1.0, self.path, slow=0.001)
+        f_foo = future(executor='process')(foo)
+
+        with mock.patch('futures.profiling.SLOW_LOGGER') as logger:
+            f_foo.async(3, 6)
+            Future.execute(FutureQueue.objects.dequeue())
+            self.assertTrue(logger.warning.called)
+        self.assertEqual({}, self.profiler.stats)
+
+    @mock.patch('tpq.put', mock_put)
+    @mock.patch('tpq.get', mock_get)
+    def test_signals(self):
+        """Ensure signals are sent around each execution."""
+        f_foo = future()(foo)
+        received = []
+
+        def _receiver(signal, **kwargs):
+            received.append((signal, kwargs))
+
+        pre_execute.connect(_receiver)
+        self.addCleanup(pre_execute.disconnect, _receiver)
+        post_execute.connect(_receiver)
+        self.addCleanup(post_execute.disconnect, _receiver)
+
+        f_foo.async(3, 6)
+        Future.execute(FutureQueue.objects.dequeue())
+
+        self.assertEqual([pre_execute, post_execute],
+                         [s for s, _ in received])
+        kwargs = received[1][1]
+        self.assertIs(f_foo, kwargs['future'])
+        self.assertFalse(kwargs['failed'])
+        self.assertEqual({'wait', 'deserialize', 'run', 'serialize'},
+                         set(kwargs['timings']))
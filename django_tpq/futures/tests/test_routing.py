@@ -0,0 +1,58 @@
+from __future__ import absolute_import
+
+from django.test import TestCase, TransactionTestCase
+
+from futures.decorators import future
+from futures.models import FutureQueue
+from futures.routing import ROUTE_BUCKETS, HashRing, route
+from futures.tests.test_futures import foo
+
+
+class HashRingTestCase(TestCase):
+    def test_route(self):
+        """Ensure keys map to stable routes."""
+        self.assertEqual(route('tenant-1'), route('tenant-1'))
+        self.assertTrue(0 <= route(12345) < ROUTE_BUCKETS)
+
+    def test_routes(self):
+        """Ensure each route is owned by exactly `group` slots."""
+        ring = HashRing(range(4))
+        owned = [ring.routes(slot) for slot in range(4)]
+        self.assertEqual(list(range(ROUTE_BUCKETS)),
+                         sorted(sum(owned, [])))
+        self.assertTrue(all(owned))
+
+        for r in range(ROUTE_BUCKETS):
+            self.assertEqual(2, len(set(ring.owners(r, group=2))))
+
+    def test_resize(self):
+        """Ensure few routes move when a slot is added."""
+        before, after = HashRing(range(4)), HashRing(range(5))
+        moved = sum(before.owners(r) != after.owners(r)
+                    for r in range(ROUTE_BUCKETS))
+        self.assertLess(moved, ROUTE_BUCKETS / 2)
+
+
+class RoutedDequeueTestCase(TransactionTestCase):
+    def setUp(self):
+        FutureQueue.objects.clear()
+
+    tearDown = setUp
+
+    def test_message(self):
+        f_foo = future(routing_key=lambda a, b: a)(foo)
+        self.assertEqual(route(3), f_foo.message((3, 6), {})['route'])
+        self.assertNotIn('route', future()(foo).message((3, 6), {}))
+
+    def test_dequeue(self):
+        """Ensure own routes are preferred, then work is stolen."""
+        FutureQueue.objects.enqueue({'route': 1, 'i': 0})
+        FutureQueue.objects.enqueue({'route': 2, 'i': 1})
+        FutureQueue.objects.enqueue({'i': 2})
+
+        self.assertEqual(1, FutureQueue.objects.dequeue(wait=0,
+                                                        routes=[2])['i'])
+        self.assertEqual(0, FutureQueue.objects.dequeue(wait=0,
+                                                        routes=[2])['i'])
+        self.assertEqual(2, FutureQueue.objects.dequeue(wait=0,
+                                                        routes=[2])['i'])
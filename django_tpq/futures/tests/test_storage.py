@@ -0,0 +1,97 @@
+from __future__ import absolute_import
+
+import io
+import os
+import shutil
+import tempfile
+
+import mock
+
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase
+
+from futures import storage
+from futures.decorators import future
+from futures.futures import Future
+from futures.models import FutureQueue
+from futures.tests.test_futures import mock_get, mock_put
+
+
+def big(n):
+    """
+    Large result function.
+    """
+    return b'x' * n
+
+
+def stream(data):
+    """
+    Stream result function.
+    """
+    return io.BytesIO(data)
+
+
+class StorageTestCase(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        patcher = mock.patch('futures.storage.RESULT_DIR', self.path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_buffer(self):
+        ref = storage.save('uid', b'data')
+        self.assertEqual('buffer', ref['kind'])
+
+        view = storage.load(ref)
+        self.assertIsInstance(view, memoryview)
+        self.assertEqual(b'data', view.tobytes())
+
+        # Files are removed once opened.
+        self.assertEqual([], os.listdir(self.path))
+
+    def test_stream(self):
+        ref = storage.save('uid', io.BytesIO(b'data'))
+        with storage.load(ref) as f:
+            self.assertEqual(b'data', f.read())
+
+    def test_object(self):
+        ref = storage.save('uid', {'foo': 'bar'})
+        self.assertEqual({'foo': 'bar'}, storage.load(ref))
+
+    def test_threshold(self):
+        with mock.patch('futures.storage.RESULT_FILE_THRESHOLD', 4):
+            self.assertFalse(storage.wants_file(b'abc'))
+            self.assertTrue(storage.wants_file(b'abcd'))
+            # Unknown size, must be pickled.
+            self.assertFalse(storage.wants_file({'a': 'bcde'}))
+
+    def test_cleanup(self):
+        storage.save('uid', b'data')
+        storage.cleanup(max_age=60)
+        self.assertEqual(1, len(os.listdir(self.path)))
+        storage.cleanup(max_age=-1)
+        self.assertEqual([], os.listdir(self.path))
+
+    @mock.patch('tpq.put', mock_put)
+    @mock.patch('tpq.get', mock_get)
+    def test_future(self):
+        f_big = future()(big)
+        f_stream = future(file_result=True)(stream)
+
+        with mock.patch('futures.storage.RESULT_FILE_THRESHOLD', 1024):
+            r_big = f_big.async(2048)
+            r_small = f_big.async(16)
+            r_stream = f_stream.async(b'data')
+            for _ in range(3):
+                Future.execute(FutureQueue.objects.dequeue())
+
+        self.assertIsInstance(r_big.result(), memoryview)
+        self.assertEqual(b'x' * 2048, r_big.result().tobytes())
+        self.assertEqual(b'x' * 16, r_small.result())
+        self.assertEqual(b'data', r_stream.result().read())
+
+    def test_not_configured(self):
+        with mock.patch('futures.storage.RESULT_DIR', None):
+            with self.assertRaises(ImproperlyConfigured):
+                future(file_result=True)(stream)
@@ -0,0 +1,85 @@
+from __future__ import absolute_import
+
+import threading
+
+import mock
+
+from django.db import connections
+from django.test import TestCase, TransactionTestCase
+
+from main.models import DelayedMessage
+from futures.decorators import future
+from futures.futures import Future
+from futures.models import FutureQueue
+from futures.throttle import Throttle, parse_rate
+from futures.tests.test_futures import foo, mock_get, mock_put
+
+
+class ParseRateTestCase(TestCase):
+    def test_parse(self):
+        self.assertEqual((100, 60), parse_rate('100/m'))
+        self.assertEqual((5, 1), parse_rate('5/s'))
+        self.assertEqual((5, 3600), parse_rate('5/hour'))
+        self.assertEqual((5, 1), parse_rate('5'))
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            parse_rate('fast')
+
+        with self.assertRaises(ValueError):
+            parse_rate('5/y')
+
+
+class ThrottleTestCase(TransactionTestCase):
+    def test_rate(self):
+        """Ensure token bucket limits rate."""
+        throttle = Throttle('test_rate', rate='2/h')
+
+        self.assertEqual((0, None), throttle.acquire())
+        self.assertEqual((0, None), throttle.acquire())
+
+        delay, slot = throttle.acquire()
+        self.assertGreater(delay, 1800)
+        self.assertIsNone(slot)
+
+    def test_concurrency(self):
+        """Ensure advisory locks limit concurrency across connections."""
+        throttle = Throttle('test_concurrency', max_concurrency=1)
+        results = []
+
+        def _acquire():
+            # Each thread has its own connection.
+            try:
+                results.append(throttle.acquire())
+            finally:
+                connections.close_all()
+
+        delay, slot = throttle.acquire()
+        self.assertEqual((0, 0), (delay, slot))
+
+        t = threading.Thread(target=_acquire)
+        t.start()
+        t.join()
+        self.assertGreater(results[0][0], 0)
+
+        throttle.release(slot)
+
+        t = threading.Thread(target=_acquire)
+        t.start()
+        t.join()
+        self.assertEqual((0, 0), results[1])
+
+    @mock.patch('tpq.put', mock_put)
+    @mock.patch('tpq.get', mock_get)
+    def test_defer(self):
+        """Ensure throttled futures are deferred."""
+        f_foo = future(rate='1/h')(foo)
+
+        f_foo.async(3, 6)
+        f_foo.async(3, 6)
+
+        Future.execute(FutureQueue.objects.dequeue())
+        self.assertFalse(DelayedMessage.objects.exists())
+
+        Future.execute(FutureQueue.objects.dequeue())
+        self.assertEqual(1, DelayedMessage.objects.count())
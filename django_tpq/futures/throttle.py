@@ -0,0 +1,121 @@
+"""
+Cluster-wide throttling of futures.
+"""
+from __future__ import absolute_import
+
+import random
+import zlib
+
+from django.db import connections
+
+from futures.models import FutureTokenBucket
+
+
+RATE_UNITS = {
+    's': 1,
+    'm': 60,
+    'h': 3600,
+    'd': 86400,
+}
+
+TAKE_TOKEN = """
+INSERT INTO %(table)s AS b (name, tokens, updated)
+VALUES (%%(name)s, %%(capacity)s - 1, clock_timestamp())
+ON CONFLICT (name) DO UPDATE SET
+    tokens = LEAST(%%(capacity)s, b.tokens + %%(per_second)s *
+        EXTRACT(EPOCH FROM clock_timestamp() - b.updated)) - 1,
+    updated = clock_timestamp()
+WHERE LEAST(%%(capacity)s, b.tokens + %%(per_second)s *
+    EXTRACT(EPOCH FROM clock_timestamp() - b.updated)) >= 1
+RETURNING tokens
+"""
+
+TAKE_SLOT = 'SELECT pg_try_advisory_lock(%s, %s)'
+
+
+def parse_rate(rate):
+    """
+    Convert a rate such as '100/m' to (count, seconds).
+    """
+    try:
+        count, _, unit = rate.partition('/')
+        return int(count), RATE_UNITS[unit[:1].lower() or 's']
+    except (KeyError, ValueError):
+        raise ValueError('Invalid rate "%s", use count/unit, where unit is '
+                         'one of s, m, h or d' % rate)
+
+
+class Throttle(object):
+    """
+    Limit concurrency and rate of a future across all executor hosts.
+
+    Concurrency is limited using Postgres advisory locks, one per slot. These
+    are held by the executing thread's connection, so are released if it
+    dies. Rate is limited using a token bucket, updated atomically with a
+    single upsert.
+    """
+
+    def __init__(self, name, max_concurrency=None, rate=None):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.count, self.seconds = parse_rate(rate) if rate else (None, None)
+        # Advisory lock keys are int4.
+        self.key = zlib.crc32(name.encode('utf-8')) - 2 ** 31
+
+    @property
+    def connection(self):
+        return connections[FutureTokenBucket.objects.db]
+
+    def _take_slot(self):
+        # One lock per statement, so none are taken but left unreported.
+        # Starting at a random slot avoids all threads contending for slot 0.
+        start = random.randrange(self.max_concurrency)
+        with self.connection.cursor() as cursor:
+            for i in range(self.max_concurrency):
+                slot = (start + i) % self.max_concurrency
+                cursor.execute(TAKE_SLOT, [self.key, slot])
+                if cursor.fetchone()[0]:
+                    return slot
+        return None
+
+    def _take_token(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(TAKE_TOKEN % {
+                'table': FutureTokenBucket._meta.db_table,
+            }, {
+                'name': self.name,
+                'capacity': self.count,
+                'per_second': self.count / self.seconds,
+            })
+            return cursor.fetchone() is not None
+
+    def acquire(self):
+        """
+        Attempt to start an execution.
+
+        Returns (delay, slot). If delay is non-zero the execution is throttled
+        and should be retried after delay seconds. Otherwise, release(slot)
+        must be called once the execution completes.
+        """
+        slot = None
+        if self.max_concurrency:
+            slot = self._take_slot()
+            if slot is None:
+                # Spread retries so they don't all arrive at once.
+                return random.uniform(0.5, 1.5), None
+
+        if self.count and not self._take_token():
+            self.release(slot)
+            return random.uniform(1.0, 1.5) * self.seconds / self.count, None
+
+        return 0, slot
+
+    def release(self, slot):
+        """
+        Release the concurrency slot taken by acquire().
+        """
+        if slot is None:
+            return
+        with self.connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_unlock(%s, %s)',
+                           [self.key, slot])
@@ -0,0 +1,71 @@
+from __future__ import absolute_import
+
+import json
+import sys
+import time
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from main.models import BaseQueue
+
+
+class Command(BaseCommand):
+    """
+    Bulk load a queue.
+    """
+
+    help = 'Load newline-delimited JSON objects into a queue using COPY.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('queue', metavar='app_label.Model',
+                            help='The queue to load.')
+        parser.add_argument('path', nargs='?', default='-',
+                            help='File to read. default: - (stdin)')
+        parser.add_argument('--chunk-size', type=int, default=10000,
+                            help='Rows per transaction. default: 10000')
+
+    def handle(self, *args, **options):
+        try:
+            Model = apps.get_model(options['queue'])
+        except (LookupError, ValueError) as e:
+            raise CommandError(str(e))
+        if not issubclass(Model, BaseQueue):
+            raise CommandError('%s is not a queue' % options['queue'])
+
+        if options['path'] == '-':
+            f = sys.stdin
+        else:
+            f = open(options['path'], 'rt')
+
+        start, total, chunk = time.time(), 0, []
+
+        def _flush():
+            # Consumers are notified once per chunk, as Postgres folds
+            # identical notifications within a transaction.
+            Model.objects.load(chunk)
+            elapsed = time.time() - start
+            self.stdout.write('%s rows, %.0f rows/s' % (
+                              total, total / elapsed if elapsed else 0))
+            del chunk[:]
+
+        try:
+            for lineno, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    d = json.loads(line)
+                except ValueError as e:
+                    raise CommandError('Line %s: %s' % (lineno, e))
+                if not isinstance(d, dict):
+                    raise CommandError('Line %s: not a JSON object' % lineno)
+                chunk.append(line)
+                total += 1
+                if len(chunk) >= options['chunk_size']:
+                    _flush()
+            if chunk:
+                _flush()
+        finally:
+            if f is not sys.stdin:
+                f.close()
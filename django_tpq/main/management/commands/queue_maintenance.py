@@ -0,0 +1,102 @@
+from __future__ import absolute_import
+
+import logging
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from main.models import BaseQueue
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def get_queue_models(labels):
+    """
+    Return the named queue models, or all of them.
+    """
+    if not labels:
+        return [m for m in apps.get_models() if issubclass(m, BaseQueue)]
+    models = []
+    for label in labels:
+        try:
+            Model = apps.get_model(label)
+        except (LookupError, ValueError) as e:
+            raise CommandError(str(e))
+        if not issubclass(Model, BaseQueue):
+            raise CommandError('%s is not a queue' % label)
+        models.append(Model)
+    return models
+
+
+class Command(BaseCommand):
+    """
+    Report and control queue table bloat.
+    """
+
+    help = 'Report dead tuples and size of queue tables, vacuuming and ' \
+           'reindexing them as needed.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('queues', nargs='*', metavar='app_label.Model',
+                            help='Queues to maintain. default: all queues.')
+        parser.add_argument('--dead-ratio', type=float, default=0.2,
+                            help='VACUUM when this fraction of tuples is '
+                                 'dead. default: 0.2')
+        parser.add_argument('--min-dead', type=int, default=1000,
+                            help='Never VACUUM with fewer dead tuples. '
+                                 'default: 1000')
+        parser.add_argument('--reindex-size', type=int, default=16,
+                            help='REINDEX when indexes exceed this many MB '
+                                 'while the queue is short. default: 16')
+        parser.add_argument('--reindex-below', type=int, default=1000,
+                            help='Only REINDEX with fewer live tuples. '
+                                 'default: 1000')
+        parser.add_argument('--tune-autovacuum', type=int, default=0,
+                            metavar='THRESHOLD',
+                            help='Configure autovacuum to run after a fixed '
+                                 'number of dead tuples.')
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help='Report only.')
+
+    def handle(self, *args, **options):
+        for Model in get_queue_models(options['queues']):
+            nodes = Model.objects.nodes()
+            for alias in nodes:
+                # Queues spread across databases are maintained on each.
+                label = Model._meta.label if len(nodes) == 1 \
+                    else '%s@%s' % (Model._meta.label, alias)
+                self.maintain(label, Model.objects.db_manager(alias),
+                              **options)
+
+    def maintain(self, label, manager, **options):
+        stats = manager.table_stats()
+        if stats is None:
+            self.stderr.write('%s: table %s not found' % (
+                              label, manager.table))
+            return
+
+        total = stats['live'] + stats['dead']
+        ratio = stats['dead'] / total if total else 0
+        self.stdout.write(
+            '%s: %s live, %s dead (%.0f%%), table %.1fMB, indexes %.1fMB, '
+            'last vacuum %s' % (
+                label, stats['live'], stats['dead'],
+                ratio * 100, stats['table_size'] / 1024 / 1024,
+                stats['index_size'] / 1024 / 1024, stats['last_vacuum']))
+
+        if options['dry_run']:
+            return
+
+        if options['tune_autovacuum']:
+            manager.tune_autovacuum(options['tune_autovacuum'])
+
+        if ratio >= options['dead_ratio'] and \
+           stats['dead'] >= options['min_dead']:
+            self.stdout.write('%s: VACUUM' % label)
+            manager.vacuum()
+
+        if stats['live'] < options['reindex_below'] and \
+           stats['index_size'] > options['reindex_size'] * 1024 * 1024:
+            self.stdout.write('%s: REINDEX' % label)
+            manager.reindex()
@@ -0,0 +1,51 @@
+from __future__ import absolute_import
+
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from main.management.commands.queue_maintenance import get_queue_models
+
+
+def parse_where(where):
+    """
+    Parse a --where option.
+    """
+    if where is None:
+        return
+    try:
+        where = json.loads(where)
+    except ValueError as e:
+        raise CommandError('--where: %s' % e)
+    if not isinstance(where, dict):
+        raise CommandError('--where: not a JSON object')
+    return where
+
+
+class Command(BaseCommand):
+    """
+    Show pending queue items.
+    """
+
+    help = 'Print pending items of a queue as newline-delimited JSON, ' \
+           'oldest first, without removing them.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('queue', metavar='app_label.Model',
+                            help='The queue to read.')
+        parser.add_argument('--limit', type=int, default=10,
+                            help='Maximum number of items. default: 10, 0 '
+                                 'for all')
+        parser.add_argument('--name',
+                            help='Only show futures with this name.')
+        parser.add_argument('--where',
+                            help='Only show items whose fields equal those '
+                                 'of this JSON object.')
+
+    def handle(self, *args, **options):
+        Model, = get_queue_models([options['queue']])
+        where = parse_where(options['where'])
+        items = Model.objects.iter_pending(name=options['name'], where=where,
+                                           limit=options['limit'] or None)
+        for _, d in items:
+            self.stdout.write(json.dumps(d))
@@ -0,0 +1,39 @@
+from __future__ import absolute_import
+
+from django.core.management.base import BaseCommand, CommandError
+
+from main.management.commands.queue_maintenance import get_queue_models
+from main.management.commands.queue_peek import parse_where
+
+
+class Command(BaseCommand):
+    """
+    Remove selected queue items.
+    """
+
+    help = 'Delete pending items of a queue matching a future name or ' \
+           'fields, in small batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('queue', metavar='app_label.Model',
+                            help='The queue to purge.')
+        parser.add_argument('--name',
+                            help='Delete futures with this name.')
+        parser.add_argument('--where',
+                            help='Delete items whose fields equal those of '
+                                 'this JSON object.')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Items deleted per transaction. default: '
+                                 '1000')
+        parser.add_argument('--keep-delayed', action='store_true',
+                            help='Do not delete matching delayed items.')
+
+    def handle(self, *args, **options):
+        Model, = get_queue_models([options['queue']])
+        where = parse_where(options['where'])
+        if options['name'] is None and not where:
+            raise CommandError('--name or --where is required')
+        count = Model.objects.purge(name=options['name'], where=where,
+                                    batch_size=options['batch_size'],
+                                    delayed=not options['keep_delayed'])
+        self.stdout.write('Purged %s items' % count)
@@ -0,0 +1,22 @@
+from django.db import transaction
+
+from main.models import enqueue_batch
+
+
+class EnqueueBatchMiddleware(object):
+    """
+    Batch all enqueue() calls made while handling a request.
+
+    Each request runs in a transaction, messages are written when it commits.
+    Error responses roll the transaction back, discarding their messages.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with enqueue_batch():
+            response = self.get_response(request)
+            if response.status_code >= 500:
+                transaction.set_rollback(True)
+            return response
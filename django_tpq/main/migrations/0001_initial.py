@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DelayedMessage',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('queue', models.CharField(max_length=256)),
+                ('eta', models.DateTimeField()),
+                ('data', django.contrib.postgres.fields.jsonb.JSONField()),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='delayedmessage',
+            index_together=set([('queue', 'eta')]),
+        ),
+    ]
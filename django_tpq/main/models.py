@@ -1,12 +1,129 @@
+import io
+import itertools
+import json
+import logging
+import threading
+import time
+
+from contextlib import contextmanager
+from datetime import timedelta
+from functools import partial
+
 from django.db import models
-from django.db import connections
-from django.db.transaction import atomic
+from django.db import connections, InterfaceError, OperationalError
+from django.db.transaction import atomic, on_commit
+from django.db import DEFAULT_DB_ALIAS
 from django.contrib.postgres.fields import JSONField
 from django.core.exceptions import ObjectDoesNotExist
+from django.utils import timezone
+
+import psycopg2
+
+from psycopg2.extras import Json, execute_values
 
 import tpq
 
 
+LOGGER = logging.getLogger(__name__)
+
+_BATCHES = threading.local()
+
+# Seconds a queue depth estimate is reused for.
+DEPTH_TTL = 1.0
+# Seconds between depth checks while blocked on a full queue.
+BLOCK_INTERVAL = 0.25
+
+# (database, table) -> (time, depth) and the set of overloaded queues.
+_DEPTHS = {}
+_OVERLOADED = set()
+
+# Seconds an unreachable database is skipped for.
+NODE_RETRY = 30.0
+# Seconds between polls of all databases while waiting to dequeue.
+POLL_INTERVAL = 0.5
+
+# Errors that mean a database is unreachable.
+NODE_ERRORS = (OperationalError, InterfaceError, psycopg2.OperationalError,
+               psycopg2.InterfaceError)
+
+# alias -> time until which it is skipped, and table -> round-robin counter.
+_DOWN = {}
+_ROUND_ROBIN = {}
+
+# Characters that must be escaped in COPY text format.
+COPY_ESCAPES = str.maketrans({
+    '\\': '\\\\',
+    '\t': '\\t',
+    '\n': '\\n',
+    '\r': '\\r',
+})
+
+
+class QueueFull(Exception):
+    """
+    Raised when enqueuing to a queue over its high water mark.
+    """
+
+
+class EnqueueBatch(object):
+    """
+    Messages buffered by enqueue_batch().
+    """
+
+    def __init__(self, using):
+        self.using = using
+        self.messages = []
+
+    def add(self, manager, d):
+        self.messages.append((manager, d))
+
+    def flush(self):
+        """
+        Write buffered messages, one INSERT per queue.
+        """
+        queues = {}
+        for manager, d in self.messages:
+            queues.setdefault(manager, []).append(d)
+        self.messages = []
+        for manager, messages in queues.items():
+            manager.enqueue_many(messages)
+
+
+def get_batch(using):
+    """
+    Return the innermost active EnqueueBatch for a database, if any.
+    """
+    for batch in reversed(getattr(_BATCHES, 'stack', [])):
+        if batch.using == using:
+            return batch
+
+
+@contextmanager
+def enqueue_batch(using=DEFAULT_DB_ALIAS):
+    """
+    Buffer enqueue() calls, writing them when the transaction commits.
+
+    Opens a transaction (or savepoint) and buffers all messages enqueued within
+    it. When the outermost transaction commits, the messages are written with
+    a single INSERT per queue. If it rolls back, they are discarded, so no
+    orphan messages remain.
+
+    Messages are written after the commit, so they are lost if the process
+    dies in between.
+    """
+    stack = _BATCHES.__dict__.setdefault('stack', [])
+    batch = EnqueueBatch(using)
+    with atomic(using=using):
+        stack.append(batch)
+        try:
+            yield batch
+        finally:
+            stack.pop()
+        # Registered last, so runs after the callbacks registered by
+        # enqueue().
+        on_commit(batch.flush, using=using)
+
+
 class BaseQueueManager(models.Manager):
     """
     Queue Manager.
@@ -28,38 +145,542 @@ class BaseQueueManager(models.Manager):
     filter = create
     get_or_create = create
 
-    @atomic
-    def enqueue(self, d):
+    @property
+    def table(self):
+        """
+        Name of the table tpq uses for this queue.
+        """
+        return 'tpq_%s' % self.model._meta.db_table
+
+    @property
+    def fanned_out(self):
+        """
+        True if the queue is spread across the model's databases.
+
+        A manager bound to a single database with db_manager() is not.
+        """
+        return self._db is None and bool(self.model.databases)
+
+    def nodes(self, healthy=False):
+        """
+        Return the database aliases holding this queue.
+
+        If `healthy`, databases recently found unreachable are left out.
+        """
+        if not self.fanned_out:
+            return [self.db]
+        nodes = list(self.model.databases)
+        if healthy:
+            now = time.time()
+            nodes = [alias for alias in nodes if _DOWN.get(alias, 0) <= now]
+        return nodes
+
+    def mark_down(self, alias):
+        """
+        Skip an unreachable database for NODE_RETRY seconds.
+        """
+        LOGGER.warning('Database %s unreachable, skipping for %ss', alias,
+                       NODE_RETRY)
+        _DOWN[alias] = time.time() + NODE_RETRY
+        try:
+            connections[alias].close()
+        except Exception:
+            # The connection is broken anyway.
+            pass
+
+    def node(self):
+        """
+        Return the database to use next, round-robin among healthy ones.
+
+        If all are down, all are tried again.
+        """
+        return self._rotation()[0]
+
+    def _rotation(self):
+        nodes = self.nodes(healthy=True) or self.nodes()
+        counter = _ROUND_ROBIN.setdefault(self.table, itertools.count())
+        i = next(counter) % len(nodes)
+        return nodes[i:] + nodes[:i]
+
+    def _failover(self, method, *args, **kwargs):
+        """
+        Call `method` on the next healthy database, failing over to the others
+        if it is unreachable.
+        """
+        error = None
+        for alias in self._rotation():
+            try:
+                return getattr(self.db_manager(alias), method)(*args, **kwargs)
+            except NODE_ERRORS as e:
+                self.mark_down(alias)
+                error = e
+        raise error
+
+    def enqueue(self, d, delay=None):
         """
         Add an item to the queue.
+
+        Within enqueue_batch(), the item is buffered until commit. If delay (in
+        seconds) is given, the item is held back until promote() is called
+        after it expires. If the queue is overloaded, the queue's overload
+        policy applies, see admit(). If the queue is spread across databases,
+        one is chosen by node().
+
+        Returns False if the overload policy refused the item, otherwise True.
         """
         assert isinstance(d, dict), 'Must enqueue a dictionary'
-        tpq.put(self.model._meta.db_table, d, conn=connections[self.db])
+        if self.fanned_out:
+            return self._failover('enqueue', d, delay=delay)
+        if self.model.high_water and not delay and not self.admit(d):
+            return False
+        if delay:
+            DelayedMessage.objects.using(self.db).create(
+                queue=self.model._meta.db_table, data=d,
+                eta=timezone.now() + timedelta(seconds=delay))
+            return True
+        batch = get_batch(self.db)
+        if batch is not None:
+            # Only buffer the item if the current savepoint is committed.
+            on_commit(partial(batch.add, self, d), using=self.db)
+            return True
+        with atomic(using=self.db):
+            tpq.put(self.model._meta.db_table, d, conn=connections[self.db])
+        return True
+
+    def depth(self, max_age=DEPTH_TTL):
+        """
+        Estimate the number of items in the queue.
+
+        Uses the span of ids, which only needs the primary key index, rather
+        than COUNT(*). Items dequeued from the middle and ids skipped by
+        rolled back inserts are counted, so the span is an upper bound. If it
+        reaches the model's high_water, items are counted instead, stopping
+        at high_water, so gaps cannot hold the queue overloaded. The estimate
+        is cached for `max_age` seconds.
+        """
+        depth = self.cached_depth(max_age)
+        if depth is None:
+            with connections[self.db].cursor() as cursor:
+                cursor.execute(*self.depth_query())
+                depth = self.cache_depth(cursor.fetchone()[0])
+        return depth
+
+    def depth_query(self):
+        """
+        Return the SQL and parameters estimating the depth, see depth().
+        """
+        return DEPTH % {'table': self.table}, {
+            'limit': self.model.high_water or None,
+        }
+
+    def cached_depth(self, max_age=DEPTH_TTL):
+        """
+        Return the cached depth, or None if it is older than `max_age`.
+        """
+        checked, depth = _DEPTHS.get((self.db, self.table), (0, 0))
+        if time.time() - checked < max_age:
+            return depth
+
+    def cache_depth(self, depth):
+        _DEPTHS[(self.db, self.table)] = (time.time(), depth)
+        return depth
+
+    def overloaded(self, depth=None):
+        """
+        Return True if the queue is overloaded.
 
-    @atomic
-    def dequeue(self, wait=-1):
+        A queue becomes overloaded once its depth reaches the model's
+        high_water and stays overloaded until it drains to low_water, so
+        producers do not flap around a single mark. `depth` is checked if
+        not given.
+        """
+        high = self.model.high_water
+        if not high:
+            return False
+        low = self.model.low_water or high
+        key = (self.db, self.table)
+        if depth is None:
+            depth = self.depth()
+        if depth >= high:
+            _OVERLOADED.add(key)
+        elif depth <= low:
+            _OVERLOADED.discard(key)
+        return key in _OVERLOADED
+
+    def admit(self, d):
+        """
+        Apply the model's overload policy, returning True to enqueue `d`.
+
+        With "raise", QueueFull is raised. With "block", waits up to the
+        model's overload_timeout seconds for the queue to drain to its low
+        water mark before raising QueueFull. With "drop", the item is
+        discarded. A callable is called with the item instead, to divert it
+        elsewhere.
+        """
+        if not self.overloaded():
+            return True
+        if self.model.overload == 'block':
+            deadline = time.time() + self.model.overload_timeout
+            while time.time() < deadline:
+                time.sleep(BLOCK_INTERVAL)
+                if not self.overloaded():
+                    return True
+            raise QueueFull('Queue %s is full, timed out after %ss' %
+                            (self.model._meta.label,
+                             self.model.overload_timeout))
+        return self.refuse(d)
+
+    def refuse(self, d):
+        """
+        Apply a non-blocking overload policy to an item that cannot be queued.
+
+        Returns False if the item was dropped or diverted, otherwise raises
+        QueueFull.
+        """
+        policy = self.model.overload
+        label = self.model._meta.label
+        if policy == 'drop':
+            LOGGER.warning('Queue %s is full, dropped item', label)
+            return False
+        if callable(policy):
+            policy(d)
+            return False
+        raise QueueFull('Queue %s is full' % label)
+
+    def enqueue_many(self, messages):
+        """
+        Add many items to the queue using a single INSERT.
+        """
+        assert all(isinstance(d, dict) for d in messages), \
+            'Must enqueue dictionaries'
+        if not messages:
+            return
+        if self.fanned_out:
+            return self._failover('enqueue_many', messages)
+        with atomic(using=self.db), connections[self.db].cursor() as cursor:
+            execute_values(cursor, 'INSERT INTO "%s" (data) VALUES %%s' %
+                           self.table, [(Json(d),) for d in messages],
+                           page_size=len(messages))
+
+    def load(self, rows):
+        """
+        Add JSON encoded items to the queue using COPY.
+
+        rows is a sequence of JSON objects as text. They are written in a
+        single transaction, to a single database.
+        """
+        if self.fanned_out:
+            return self._failover('load', rows)
+        buffer = io.StringIO(''.join(
+            '%s\n' % row.translate(COPY_ESCAPES) for row in rows))
+        with atomic(using=self.db), connections[self.db].cursor() as cursor:
+            cursor.copy_expert('COPY "%s" (data) FROM STDIN' % self.table,
+                               buffer)
+
+    def promote(self, limit=1000):
+        """
+        Move up to `limit` delayed items that are due onto the queue.
+
+        Returns the number of items moved. Each database holds its own delayed
+        items, unreachable ones are skipped.
+        """
+        if self.fanned_out:
+            count = 0
+            for alias in self.nodes(healthy=True):
+                try:
+                    count += self.db_manager(alias).promote(limit)
+                except NODE_ERRORS:
+                    self.mark_down(alias)
+            return count
+        with atomic(using=self.db), connections[self.db].cursor() as cursor:
+            cursor.execute(PROMOTE % {
+                'delayed': DelayedMessage._meta.db_table,
+                'table': self.table,
+            }, {
+                'queue': self.model._meta.db_table,
+                'limit': limit,
+            })
+            return cursor.rowcount
+
+    def dequeue(self, wait=-1, routes=None):
         """
         Return a single item from the queue, optionally waiting.
+
+        As with tpq, a negative `wait` returns at once, 0 waits forever and a
+        positive `wait` waits up to that many seconds. If routes are given,
+        the oldest item whose "route" field is one of them is preferred, then
+        any item is taken. If the queue is spread across databases, each
+        healthy one is polled in turn until an item is found or the wait
+        ends.
         """
+        if self.fanned_out:
+            return self._dequeue_any(wait, routes)
+        if routes:
+            with atomic(using=self.db), \
+                    connections[self.db].cursor() as cursor:
+                cursor.execute(DEQUEUE_ROUTED % {'table': self.table},
+                               [[str(r) for r in routes]])
+                row = cursor.fetchone()
+            if row is not None:
+                return row[0]
         try:
-            return tpq.get(self.model._meta.db_table, wait=wait,
-                           conn=connections[self.db])
+            with atomic(using=self.db):
+                return tpq.get(self.model._meta.db_table, wait=wait,
+                               conn=connections[self.db])
         except tpq.QueueEmpty:
             raise ObjectDoesNotExist
 
-    @atomic
+    def _dequeue_any(self, wait, routes=None):
+        deadline = time.time() + wait
+        while True:
+            for alias in self._rotation():
+                try:
+                    # Never block on one database while others have items.
+                    return self.db_manager(alias).dequeue(wait=-1,
+                                                          routes=routes)
+                except ObjectDoesNotExist:
+                    pass
+                except NODE_ERRORS:
+                    self.mark_down(alias)
+            if wait < 0 or wait > 0 and time.time() >= deadline:
+                raise ObjectDoesNotExist
+            time.sleep(POLL_INTERVAL)
+
     def clear(self):
         """
         Delete all items from the queue.
         """
-        tpq.clear(self.model._meta.db_table, conn=connections[self.db])
+        for alias in self.nodes():
+            with atomic(using=alias):
+                tpq.clear(self.model._meta.db_table, conn=connections[alias])
+
+    def _match(self, name=None, where=None):
+        """
+        Build a WHERE clause matching items by future name and/or fields.
+
+        `where` maps top-level fields to the JSON values they must equal.
+        """
+        clauses, params = [], []
+        if name is not None:
+            # Uses the expression index on data->>'name', if present.
+            clauses.append("data->>'name' = %s")
+            params.append(name)
+        for key, value in sorted((where or {}).items()):
+            clauses.append('(data->%s)::jsonb = %s::jsonb')
+            params.extend([key, json.dumps(value)])
+        return ' AND '.join(clauses) or 'TRUE', params
+
+    def peek(self, n=10, name=None, where=None):
+        """
+        Return up to `n` (id, item) pairs from the head of the queue without
+        removing them.
+        """
+        return list(self.iter_pending(batch_size=n, name=name, where=where,
+                                      limit=n))
+
+    def iter_pending(self, batch_size=1000, name=None, where=None,
+                     limit=None):
+        """
+        Yield (id, item) for items in the queue, oldest first.
+
+        Reads `batch_size` items per query, paging on the primary key, so the
+        table is never loaded whole and no locks are held between batches.
+        Items dequeued meanwhile may or may not be seen. A queue spread across
+        databases is read one database after another.
+        """
+        if self.fanned_out:
+            items = itertools.chain.from_iterable(
+                self.db_manager(alias).iter_pending(batch_size, name, where,
+                                                    limit)
+                for alias in self.nodes())
+            yield from itertools.islice(items, limit)
+            return
+        clause, params = self._match(name, where)
+        sql = 'SELECT id, data FROM "%s" WHERE id > %%s AND %s ' \
+              'ORDER BY id LIMIT %%s' % (self.table, clause)
+        last, count = 0, 0
+        while limit is None or count < limit:
+            size = batch_size if limit is None \
+                else min(batch_size, limit - count)
+            with connections[self.db].cursor() as cursor:
+                cursor.execute(sql, [last] + params + [size])
+                rows = cursor.fetchall()
+            for last, d in rows:
+                yield last, d
+            count += len(rows)
+            if len(rows) < size:
+                break
+
+    def purge(self, name=None, where=None, batch_size=1000, delayed=True):
+        """
+        Delete items matching a future name and/or fields.
+
+        Deletes at most `batch_size` items per transaction, skipping items
+        locked by consumers, so the queue stays available. Matching delayed
+        items are also deleted unless `delayed` is False. Returns the number
+        of items deleted. Use clear() to delete everything.
+        """
+        if name is None and not where:
+            raise ValueError('purge() requires name or where')
+        if self.fanned_out:
+            return sum(self.db_manager(alias).purge(name, where, batch_size,
+                                                    delayed)
+                       for alias in self.nodes())
+        clause, params = self._match(name, where)
+        tables = [(self.table, '')]
+        if delayed:
+            tables.append((DelayedMessage._meta.db_table, 'queue = %s AND '))
+        total = 0
+        for table, extra in tables:
+            sql = PURGE % {'table': table, 'where': extra + clause}
+            extra_params = [self.model._meta.db_table] if extra else []
+            while True:
+                with atomic(using=self.db), \
+                        connections[self.db].cursor() as cursor:
+                    cursor.execute(sql, extra_params + params + [batch_size])
+                    deleted = cursor.rowcount
+                total += deleted
+                if not deleted:
+                    break
+        return total
+
+    def table_stats(self):
+        """
+        Report size and dead tuple statistics for the queue table.
+        """
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(TABLE_STATS, [self.table])
+            row = cursor.fetchone()
+            if row is None:
+                return
+            columns = [c[0] for c in cursor.description]
+            return dict(zip(columns, row))
+
+    def vacuum(self):
+        """
+        VACUUM the queue table, reclaiming space used by dead tuples.
+
+        Cannot be called within a transaction.
+        """
+        with connections[self.db].cursor() as cursor:
+            cursor.execute('VACUUM ANALYZE "%s"' % self.table)
+
+    def reindex(self):
+        """
+        Rebuild the queue table's indexes.
+
+        Takes an exclusive lock, so is best done while the queue is short.
+        """
+        with connections[self.db].cursor() as cursor:
+            cursor.execute('REINDEX TABLE "%s"' % self.table)
+
+    def tune_autovacuum(self, threshold=1000):
+        """
+        Vacuum the queue table after a fixed number of dead tuples.
+
+        The default, a fraction of the table size, is far too lax for a
+        table with heavy churn and few live tuples.
+        """
+        with connections[self.db].cursor() as cursor:
+            cursor.execute('ALTER TABLE "%s" SET ('
+                           'autovacuum_vacuum_scale_factor = 0, '
+                           'autovacuum_vacuum_threshold = %d, '
+                           'autovacuum_analyze_scale_factor = 0, '
+                           'autovacuum_analyze_threshold = %d)' %
+                           (self.table, threshold, threshold))
 
-    @atomic
     def count(self):
         """
-        Counts items in the queue.
+        Counts items in the queue, across all of its databases.
         """
-        return tpq.count(self.model._meta.db_table, conn=connections[self.db])
+        count = 0
+        for alias in self.nodes():
+            with atomic(using=alias):
+                count += tpq.count(self.model._meta.db_table,
+                                   conn=connections[alias])
+        return count
+
+
+PROMOTE = """
+WITH due AS (
+    DELETE FROM "%(delayed)s"
+    WHERE id IN (
+        SELECT id
+        FROM "%(delayed)s"
+        WHERE queue = %%(queue)s AND eta <= now()
+        ORDER BY eta
+        FOR UPDATE SKIP LOCKED
+        LIMIT %%(limit)s
+    )
+    RETURNING eta, data
+)
+INSERT INTO "%(table)s" (data)
+SELECT data::json FROM due ORDER BY eta
+"""
+
+
+DEQUEUE_ROUTED = """
+DELETE FROM "%(table)s"
+WHERE id = (
+    SELECT id
+    FROM "%(table)s"
+    WHERE data->>'route' = ANY(%%s)
+    ORDER BY id
+    FOR UPDATE SKIP LOCKED
+    LIMIT 1
+)
+RETURNING data
+"""
+
+
+DEPTH = """
+SELECT CASE WHEN span >= %%(limit)s THEN (
+    SELECT count(*) FROM (
+        SELECT 1 FROM "%(table)s" LIMIT %%(limit)s
+    ) AS live
+) ELSE span END
+FROM (SELECT COALESCE(max(id) - min(id) + 1, 0) AS span
+      FROM "%(table)s") AS ids
+"""
+
+PURGE = """
+DELETE FROM "%(table)s"
+WHERE id IN (
+    SELECT id
+    FROM "%(table)s"
+    WHERE %(where)s
+    FOR UPDATE SKIP LOCKED
+    LIMIT %%s
+)
+"""
+
+
+TABLE_STATS = """
+SELECT n_live_tup AS live,
+       n_dead_tup AS dead,
+       pg_relation_size(relid) AS table_size,
+       pg_indexes_size(relid) AS index_size,
+       GREATEST(last_vacuum, last_autovacuum) AS last_vacuum
+FROM pg_stat_user_tables
+WHERE relname = %s
+"""
+
+
+class DelayedMessage(models.Model):
+    """
+    Queue item held back until a later time.
+
+    Moved onto its queue by BaseQueueManager.promote().
+    """
+
+    class Meta:
+        index_together = ('queue', 'eta')
+
+    id = models.BigAutoField(primary_key=True)
+    # db_table of the destination queue.
+    queue = models.CharField(max_length=256)
+    eta = models.DateTimeField()
+    data = JSONField()
 
 
 class BaseQueue(models.Model):
@@ -79,5 +700,17 @@ class BaseQueue(models.Model):
     id = models.BigAutoField(primary_key=True)
     data = JSONField()
 
+    # Producer backpressure, see BaseQueueManager.admit(). Disabled unless
+    # high_water is set. low_water defaults to high_water.
+    high_water = None
+    low_water = None
+    # "raise", "block", "drop" or a callable taking the item.
+    overload = 'raise'
+    overload_timeout = 10.0
+
+    # Database aliases to spread the queue across, see
+    # BaseQueueManager.nodes(). By default the router chooses one.
+    databases = None
+
     # Use our manager, this is inherited.
     objects = BaseQueueManager()